@@ -0,0 +1,177 @@
+# smlm_proxy.py
+# This is a custom Salt Beacon module.
+#
+# To use this module:
+# 1. Place this file in your Salt master's `_beacons` directory (e.g., /srv/salt/_beacons/).
+# 2. Sync the beacons to your minions: `salt '*' saltutil.sync_beacons`
+#    or `salt '*' saltutil.sync_all`
+# 3. Configure the beacon in the minion configuration or pillar, e.g.:
+#
+#    beacons:
+#      smlm_proxy:
+#        - interval: 10
+#        - debounce: 20
+#
+# The beacon reads the state of the uyuni-proxy-* units with one 'systemctl show' per interval and only fires
+# an event when something changes:
+#   salt/beacon/<minion>/smlm_proxy/down            a container stopped running
+#   salt/beacon/<minion>/smlm_proxy/up              a container is running again
+#   salt/beacon/<minion>/smlm_proxy/restart_loop    a container was restarted too often by systemd
+#   salt/beacon/<minion>/smlm_proxy/cache_full      the volume of the squid cache is nearly full
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "smlm_proxy"
+
+PROXY_UNITS = "uyuni-proxy-*.service"
+PROXY_UNIT_PROPERTIES = "Id,ActiveState,SubState,NRestarts"
+SQUID_CACHE_DIR = "/var/lib/containers/storage/volumes/uyuni-proxy-squid-cache/_data"
+STATE_KEY = "smlm_proxy.beacon"
+# default configuration. Times are in seconds, cache_threshold is the used percentage of the cache volume
+DEFAULTS = {'debounce': 20,
+            'rate_limit': 300,
+            'restart_threshold': 3,
+            'restart_window': 600,
+            'cache_threshold': 90}
+
+
+def __virtual__():
+    """
+    Only load the beacon on systems with systemd.
+    """
+    if os.path.isdir("/run/systemd/system"):
+        return __virtualname__
+    return False, "The smlm_proxy beacon requires systemd"
+
+
+def _config(config):
+    """
+    Merge the beacon configuration, a list of single key dicts, with the defaults.
+    """
+    merged = dict(DEFAULTS)
+    for item in config:
+        merged.update(item)
+    return merged
+
+
+def validate(config):
+    """
+    Validate the beacon configuration.
+    """
+    if not isinstance(config, list):
+        return False, "Configuration for smlm_proxy beacon must be a list"
+    for item in config:
+        if not isinstance(item, dict):
+            return False, "Configuration for smlm_proxy beacon must be a list of dictionaries"
+    for key, value in _config(config).items():
+        if key in DEFAULTS and (not isinstance(value, (int, float)) or value < 0):
+            return False, f"Configuration value {key} for smlm_proxy beacon must be a positive number"
+    return True, "Valid beacon configuration"
+
+
+def _unit_states():
+    """
+    Get the active state and restart count of the uyuni-proxy-* units.
+
+    :return: dict with per unit the active state and restart count, or None when systemctl failed
+    """
+    ret = __salt__['cmd.run_all'](["systemctl", "show", f"--property={PROXY_UNIT_PROPERTIES}", PROXY_UNITS],
+                                  python_shell=False, ignore_retcode=True, output_loglevel='quiet')
+    if ret['retcode'] != 0:
+        return None
+    units = {}
+    for block in ret['stdout'].split("\n\n"):
+        properties = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        if not properties.get('Id'):
+            continue
+        try:
+            restarts = int(properties.get('NRestarts') or 0)
+        except ValueError:
+            restarts = 0
+        units[properties['Id'].rsplit(".service", 1)[0]] = {'active': properties.get('ActiveState'),
+                                                             'sub': properties.get('SubState'),
+                                                             'restarts': restarts}
+    return units
+
+
+def _cache_usage():
+    """
+    Get the used percentage of the volume of the squid cache.
+    """
+    try:
+        volume = os.statvfs(SQUID_CACHE_DIR)
+    except OSError:
+        return None
+    if not volume.f_blocks:
+        return None
+    return round(100 * (volume.f_blocks - volume.f_bavail) / volume.f_blocks, 1)
+
+
+def _fire(state, events, tag, key, data, config, now):
+    """
+    Add an event, unless an event with the same key was fired within rate_limit seconds.
+    """
+    last = state['fired'].get(key)
+    if last is not None and now - last < config['rate_limit']:
+        log.debug(f"smlm_proxy beacon: event {tag} for {key} suppressed by rate limit")
+        return
+    state['fired'][key] = now
+    events.append(dict(data, tag=tag))
+
+
+def beacon(config):
+    """
+    Watch the containers and the cache volume of the SMLM proxy and fire events on changes.
+    """
+    config = _config(config)
+    now = time.monotonic()
+    state = __context__.setdefault(STATE_KEY, {'units': {}, 'restarts': {}, 'fired': {}, 'cache_full': False})
+    events = []
+
+    units = _unit_states()
+    if units is None:
+        return events
+    for name, unit in units.items():
+        running = unit['active'] == 'active'
+        known = state['units'].setdefault(name, {'running': None, 'pending': None, 'pending_since': now})
+        # a new state is only confirmed when it is seen for debounce seconds
+        if known['running'] == running:
+            known['pending'] = None
+        else:
+            if known['pending'] != running:
+                known['pending'] = running
+                known['pending_since'] = now
+            if now - known['pending_since'] >= config['debounce']:
+                previous = known['running']
+                known['running'] = running
+                known['pending'] = None
+                # at the first confirmation only a container that is not running is reported
+                if previous is not None or not running:
+                    tag = "up" if running else "down"
+                    _fire(state, events, tag, f"{tag}:{name}",
+                          {'container': name, 'active': unit['active'], 'sub': unit['sub']}, config, now)
+
+        history = state['restarts'].setdefault(name, {'count': unit['restarts'], 'times': []})
+        restarted = unit['restarts'] > history['count']
+        if restarted:
+            history['times'].extend([now] * (unit['restarts'] - history['count']))
+        history['count'] = unit['restarts']
+        history['times'] = [t for t in history['times'] if now - t < config['restart_window']]
+        if restarted and config['restart_threshold'] and len(history['times']) >= config['restart_threshold']:
+            _fire(state, events, "restart_loop", f"restart_loop:{name}",
+                  {'container': name, 'restarts': len(history['times']), 'window': config['restart_window'],
+                   'active': unit['active']}, config, now)
+
+    usage = _cache_usage()
+    if usage is not None:
+        if usage >= config['cache_threshold'] and not state['cache_full']:
+            state['cache_full'] = True
+            _fire(state, events, "cache_full", "cache_full", {'used_percent': usage,
+                                                                'threshold': config['cache_threshold']}, config, now)
+        elif usage < config['cache_threshold'] - 5:
+            # 5 percent hysteresis, so a cache around the threshold does not fire continuously
+            state['cache_full'] = False
+    return events
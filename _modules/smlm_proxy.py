@@ -1,12 +1,47 @@
-import base64
+import contextvars
+import functools
+import json
 import logging
 import os
-import socket
-import xmlrpc.client
+import threading
+import time
+import urllib.parse
 
 # Initialize Salt's logger
 log = logging.getLogger(__name__)
 
+# constants of the SMLM API, the timeouts, the configuration, the offline bundle and the execution of commands are
+# in _utils/smlm_proxy_core.py. The timeouts are available as ProxyCore.probe_timeout and ProxyCore.read_timeout
+# API (https) and salt ports of SMLM
+PROBE_PORTS = [443, 4505, 4506]
+# readiness of the proxy after a restart: the salt broker ports are polled with exponential backoff
+READY_PORTS = [4505, 4506]
+READY_BACKOFF_START = 0.5
+READY_BACKOFF_MAX = 8
+RESTART_DEADLINE = 300
+# path used by the clients to download packages and repository metadata through the proxy
+DOWNLOAD_PATH = "/rhn/manager/download"
+WARM_PROGRESS_INTERVAL = 500
+# duration and outcome of the last install, clearcaches and restart, used by metrics
+OPERATIONS_FILE = "smlm_proxy/last_operations.json"
+# operations that can be executed as job with detach=True. The job records, the operation lock and the progress
+# events are handled by _utils/smlm_proxy_core.py
+JOB_OPERATIONS = ("install", "clearcaches")
+# squid access log, relative to the root filesystem of the squid container
+SQUID_CONTAINER = "uyuni-proxy-squid"
+SQUID_ACCESS_LOG = "/var/log/squid/access.log"
+CACHE_REPORT_FILE = "smlm_proxy/cache_report.json"
+# number of missed urls tracked. Only the most missed urls are kept, so memory use stays constant
+CACHE_REPORT_TRACKED_URLS = 2000
+SQUID_CACHE_DIR = "/var/lib/containers/storage/volumes/uyuni-proxy-squid-cache/_data"
+# squid stores its objects in <L1>/<L2> directories. Each directory on this depth is purged by its own task
+PURGE_SPLIT_DEPTH = 2
+PURGE_PROGRESS_INTERVAL = 50000
+CACHE_INDEX_FILE = "smlm_proxy/squid_cache_index.json"
+CACHE_SIZE_BUCKETS = [(4096, "<4KiB"), (65536, "<64KiB"), (1048576, "<1MiB"), (16777216, "<16MiB"),
+                      (134217728, "<128MiB"), (None, ">=128MiB")]
+CACHE_AGE_BUCKETS = [(1, "<1d"), (7, "<7d"), (30, "<30d"), (90, "<90d"), (None, ">=90d")]
+
 def __virtual__():
     """
     This function is a Salt convention. It determines if the module should be
@@ -14,60 +49,40 @@ def __virtual__():
     """
     return True
 
+def _core():
+    """
+    Get the implementation shared with the smlmproxy state module, bound to the dunders of this module.
+    :return: ProxyCore
+    """
+    return __utils__['smlm_proxy_core.core'](__salt__, __opts__, __context__)
+
 def _proxy_software_installed():
     """
     Check if the proxy software is installed.
     :return:
     """
-    if os.path.isfile("/usr/bin/mgrpxy") and os.path.isfile("/usr/bin/podman"):
-        return True
-    return False
+    return _core().software_installed()
 
-def _proxy_software_install(internet_access, os_finger):
+def _execute_command(cmd, **kwargs):
     """
-    Install proxy software.
-
-    :param internet_access:
-    :return:
+    Execute the given command without a shell, see ProxyCore.execute_command().
+    :return: dict with success, message (stdout), error (stderr), retcode, duration and truncated
     """
-    cpu_arch = __salt__['grains.get']('cpuarch')
-
-    if internet_access:
-        packages = f"podman uyuni-storage-setup-proxy mgrpxy* mgrctl*"
-    else:
-        packages = f"podman uyuni-storage-setup-proxy mgrpxy* mgrctl* suse-manager-5.0-{cpu_arch}-proxy-*"
-    if "sle micro" in os_finger.lower():
-        ret = _execute_command(f"transactional-update -i pkg in {packages}")
-        if ret['success']:
-            _execute_command("systemctl enable podman")
-            ret['message'] = "Software installed. Reboot server and re-issue the same command to install proxy"
-        return ret
-    else:
-        ret=_execute_command(f"zypper -n in {packages}")
-        if ret['success']:
-            ret1 = _execute_command("systemctl enable --now podman")
-            return ret1
-        else:
-            return ret
+    return _core().execute_command(cmd, **kwargs)
 
-def _get_pillar_data(pillar_key, error=True, default_value=None):
+def _login_smlm(config=None):
     """
-    Get the value of the given pillar key. Return None if it isn't found or if it is empty.
-
-    :param pillar_key:
-    :return: value of the pillar key
+    Login to SMLM. The session is kept in __context__, use _logout_smlm() to end it.
+    :return: error, client connections and session key
     """
-    data = __salt__['pillar.get'](pillar_key)
+    return _core().login_smlm(config)
 
-    if data is None or not data:
-        if error:
-            error = (f"Pillar keys {pillar_key} is empty or not present. Please fix pillar data for "
-                     f"server {__salt__['grains.get']('fqdn')}.")
-            return None, error
-        else:
-            if default_value:
-                return default_value, None
-    return data, None
+def _logout_smlm():
+    """
+    Logout from SMLM when a session is present and close the connection.
+    :return:
+    """
+    _core().logout_smlm()
 
 def _check_if_active():
     """
@@ -79,123 +94,187 @@ def _check_if_active():
         ret = status()
         if ret['success']:
             return {'success': True, 'message': "Proxy already running"}
-        if os.path.isfile("/etc/uyuni/proxy/config.yaml") or os.path.isfile("/etc/uyuni/proxy/httpd.yaml") or os.path.isfile("/etc/uyuni/proxy/ssh.yaml"):
+        if _core().config_deployed():
             return {'success': True, 'message': "Proxy already configured"}
     return {'success': False, 'message': "Proxy not configured"}
 
-def _check_parameters():
+def _load_operations():
     """
-    Check if the certificate date is available and if this is the case,
-    create the config file for the proxy.
+    Load the duration and outcome of the last operations.
+    :return: dict with per operation the timestamp, duration and success
+    """
+    try:
+        with open(os.path.join(__opts__['cachedir'], OPERATIONS_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _recorded(operation):
+    """
+    Decorator recording the duration and outcome of an operation for metrics().
+
+    :param operation: name of the operation
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = time.monotonic()
+            ret = func(*args, **kwargs)
+            operations = _load_operations()
+            operations[operation] = {'timestamp': round(time.time(), 3),
+                                     'duration': round(time.monotonic() - start_time, 3),
+                                     'success': bool(ret.get('success'))}
+            operations_file = os.path.join(__opts__['cachedir'], OPERATIONS_FILE)
+            try:
+                os.makedirs(os.path.dirname(operations_file), exist_ok=True)
+                with open(f"{operations_file}.tmp", 'w') as f:
+                    json.dump(operations, f)
+                os.replace(f"{operations_file}.tmp", operations_file)
+            except OSError as e:
+                log.warning(f"Unable to record the outcome of {operation}: {e}")
+            return ret
+        return wrapper
+    return decorator
+
+def _salt_call():
+    """
+    Get the salt-call command of this minion, also when it is the Salt bundle (venv-salt-minion).
+    :return: list with the command and the configuration directory
+    """
+    conf_file = __opts__.get('conf_file') or ""
+    salt_call = "venv-salt-call" if "venv-salt-minion" in conf_file else "salt-call"
+    return [salt_call] + (["--config-dir", os.path.dirname(conf_file)] if conf_file else [])
+
+def _submit_job(operation, args, kwargs):
+    """
+    Record a job for the operation and start a salt-call process executing it with run_job. The minion worker is
+    not held while the job runs.
+
+    :param operation: name of the operation
+    :param args: positional arguments of the operation
+    :param kwargs: keyword arguments of the operation
     :return:
     """
-    root_crt, err = _get_pillar_data("proxy:root_crt")
+    err = _core().lock_error(operation)
     if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    server_crt, err = _get_pillar_data("proxy:server_crt")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    server_key, err = _get_pillar_data("proxy:server_key")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    smlm_cred, err = _get_pillar_data("proxy:smlmcred")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    email, err = _get_pillar_data("proxy:email")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    return {'success': True}
+        ret = {'success': False, 'message': err}
+        log.error(ret['message'])
+        return ret
+    job = _core().new_job(operation, args, kwargs)
+    started = __salt__['cmd.run_bg'](_salt_call() + ["--out=quiet", "smlm_proxy.run_job", job['job']],
+                                     python_shell=False)
+    return {'success': True, 'job': job['job'], 'pid': started.get('pid'),
+            'message': f"{operation} started as job {job['job']}, "
+                       f"use smlm_proxy.job_status job={job['job']} to follow it"}
 
-def _login_smlm():
+def _exclusive(operation):
     """
-    Login to SMLM
-    :return: error, client connections and session key
+    Decorator allowing only one operation changing the proxy at a time, see ProxyCore.operation_lock(). When the
+    function is called with detach=True, it is executed as job and the job id is returned directly. Only the
+    operations in JOB_OPERATIONS can be executed as job.
+
+    :param operation: name of the operation
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.connect_ex((__salt__['grains.get']('master'), 443))
-    except Exception:
-        error = f"Unable to login to SUSE Manager server {__salt__['grains.get']('master')}."
-        return error, None, None
-    client = xmlrpc.client.Server("https://" + __salt__['grains.get']('master') + "/rpc/api")
-    smlm_cred, err = _get_pillar_data("proxy:smlmcred")
-    credentials = base64.b64decode(smlm_cred).decode('utf-8')
-    try:
-        session = client.auth.login(credentials.split(':')[0], credentials.split(':', 1)[1])
-    except Exception:
-        error = f"Unable to login to SUSE Manager server {__salt__['grains.get']('master')}."
-        return error, None, None
-    return None, client, session
-
-def _get_config():
-    # login to SMLM
-    err, client, session = _login_smlm()
-    if err:
-        return {'error': err, 'success': False}
-
-    # collecting all needed parameters
-    root_crt, _ = _get_pillar_data("proxy:root_crt")
-    server_crt, _ = _get_pillar_data("proxy:server_crt")
-    server_key, _ = _get_pillar_data("proxy:server_key")
-    email, _ = _get_pillar_data("proxy:email")
-    proxy_port, _ = _get_pillar_data("proxy:proxyport", error=False, default_value=8022)
-    max_cache, err = _get_pillar_data("proxy:maxcache", error=False, default_value=2048)
-    intermediate_crt, err = _get_pillar_data("proxy:intermediate_crt", error=False, default_value=[])
-    proxy_name = __salt__['grains.get']('fqdn')
-    smlm = __salt__['grains.get']('master')
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if kwargs.pop('detach', False):
+                if operation not in JOB_OPERATIONS:
+                    ret = {'success': False, 'message': f"{operation} can not be executed as job, "
+                                                        f"detach is only supported by {', '.join(JOB_OPERATIONS)}"}
+                    log.error(ret['message'])
+                    return ret
+                return _submit_job(operation, args, kwargs)
+            with _core().operation_lock(operation) as err:
+                if err:
+                    ret = {'success': False, 'message': err}
+                    log.error(ret['message'])
+                    return ret
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
-    intermediate = []
-    for x in intermediate_crt:
-        intermediate.append(x)
+def run_job(job):
+    """
+    Execute a job submitted with detach=True. Started by the salt-call process of the job, not meant to be called
+    directly. The progress and the result are recorded for job_status and sent as events with tag
+    smlm_proxy/job/<job>/progress and smlm_proxy/job/<job>/done.
 
-    # ask smlm to create the config file
-    try:
-        config_file = client.proxy.container_config(session, proxy_name, proxy_port, smlm, max_cache, email, root_crt, intermediate, server_crt, server_key)
-    except Exception:
-        return {'error': "Unable to get config file", 'success': False}
-    # write config file to /etc/uyuni/proxy
-    file_config="/etc/uyuni/config.tar.gz"
-    try:
-        # Ensure the directory exists before writing the file
-        os.makedirs(os.path.dirname(file_config), exist_ok=True)
-        with open(file_config, 'wb') as f:
-            f.write(config_file.data)
-    except Exception as file_write_error:
-        return {'error': f"Error when writing the file\n{str(file_write_error)}\n{file_config}", 'success': False}
-    return {'success': True}
-
-def _execute_command(cmd):
-    """
-    This function will execute a command and return its output.
-    :param cmd:
+    :param job: id of the job
     :return:
     """
-    ret = {}
-    cmd_result = __salt__['cmd.run_all'](cmd, python_shell=True)
-    if cmd_result['retcode'] != 0:
-        ret.update({'success': False, 'message': cmd_result['stdout'], 'error': cmd_result['stderr']})
+    record = _core().read_job(job)
+    if record is None:
+        ret = {'success': False, 'message': f"Job {job} not found"}
         log.error(ret['message'])
-    else:
-        ret['success'] = True
-        ret['message'] = cmd_result['stdout']
+        return ret
+    if record['operation'] not in JOB_OPERATIONS:
+        ret = {'success': False, 'message': f"Job {job} can not be executed, operation {record['operation']} "
+                                            f"is not supported as job"}
+        log.error(ret['message'])
+        return ret
+    if record['state'] != "queued":
+        ret = {'success': False, 'message': f"Job {job} can not be executed, state is {record['state']}"}
+        log.error(ret['message'])
+        return ret
+    _core().start_job(record)
+    try:
+        ret = globals()[record['operation']](*record['args'], **record['kwargs'])
+    except Exception as e:
+        log.exception(f"Job {job} failed")
+        ret = {'success': False, 'message': f"{record['operation']} failed: {e}"}
+    _core().finish_job(ret)
     return ret
 
-def status():
+def job_status(job=None, limit=10):
+    """
+    Get the state, progress and result of a job started with detach=True.
+
+    example: salt '<fqdn>' smlm_proxy.job_status job=<job>
+             salt '<fqdn>' smlm_proxy.job_status
+
+    :param job: id of the job. When not given, the most recent jobs and the running operation are returned.
+    :param limit: maximum number of jobs returned when no job is given
+    :return: the state is queued, running, success, failed or lost (the process of the job died)
+    """
+    if job is None:
+        jobs = [{key: record.get(key) for key in ('job', 'operation', 'state', 'submitted', 'duration', 'progress')}
+                for record in _core().list_jobs(limit)]
+        return {'success': True, 'message': f"{len(jobs)} jobs found", 'jobs': jobs,
+                'running': _core().lock_holder()}
+    record = _core().read_job(job)
+    if record is None:
+        ret = {'success': False, 'message': f"Job {job} not found"}
+        log.error(ret['message'])
+        return ret
+    message = f"Job {job} ({record['operation']}) is {record['state']}"
+    if record.get('result'):
+        message += f": {record['result'].get('message')}"
+    return dict(record, success=record['state'] not in ("failed", "lost"), message=message)
+
+def status(verbose=False):
     """
     Get the status of the SMLM proxy.
 
     example: salt '<fqdn>' smlm_proxy.status
+             salt '<fqdn>' smlm_proxy.status verbose=True
 
+    :param verbose: When True, the complete output of 'mgrpxy status' is returned. Otherwise, a compact
+                    status per container is returned.
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy status'
-        return _execute_command(cmd)
+        if verbose:
+            cmd = ["mgrpxy", "status"]
+            return _execute_command(cmd)
+        containers = _core().containers_status()
+        if not containers:
+            ret = {'success': False, 'message': "No SMLM Proxy containers found", 'containers': {}}
+            log.error(ret['message'])
+            return ret
+        if all(container['active'] == 'active' for container in containers.values()):
+            return {'success': True, 'message': "SMLM Proxy running", 'containers': containers}
+        return {'success': False, 'message': "SMLM Proxy not running", 'containers': containers}
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
         log.error(ret['message'])
@@ -211,7 +290,7 @@ def stop():
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy stop'
+        cmd = ["mgrpxy", "stop"]
         return _execute_command(cmd)
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
@@ -227,91 +306,1208 @@ def start():
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy start'
+        cmd = ["mgrpxy", "start"]
         return _execute_command(cmd)
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
         log.error(ret['message'])
         return ret
 
-def restart():
+def _check_https_ready(host, timeout):
+    """
+    Check if the httpd container of the proxy answers https requests. The certificate is not verified,
+    only the availability of the service is checked.
+
+    :param host: fqdn of the proxy
+    :param timeout: timeout in seconds
+    :return: error, or None when httpd answers
+    """
+    import http.client
+    import ssl
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    connection = http.client.HTTPSConnection(host, 443, timeout=timeout, context=context)
+    try:
+        connection.request("HEAD", "/")
+        status = connection.getresponse().status
+    except (OSError, http.client.HTTPException) as e:
+        return f"https: {e}"
+    finally:
+        connection.close()
+    if status >= 500:
+        return f"https: status {status}"
+    return None
+
+def _check_squid_ready():
+    """
+    Check if squid is running in the squid container.
+
+    :return: error, or None when squid is running
+    """
+    ret = __salt__['cmd.run_all'](["podman", "exec", SQUID_CONTAINER, "squid", "-k", "check"],
+                                  python_shell=False, ignore_retcode=True)
+    if ret['retcode'] != 0:
+        return f"squid: {ret['stderr'] or ret['stdout'] or 'not running'}"
+    return None
+
+def _readiness_checks(host, timeout):
+    """
+    Get the readiness checks of the proxy: https on port 443, the salt broker on port 4505 and 4506 and squid.
+
+    :param host: fqdn of the proxy
+    :param timeout: timeout in seconds for every check
+    :return: dict with per check a function returning an error, or None when ready
+    """
+    checks = {'https': lambda: _check_https_ready(host, timeout), 'squid': _check_squid_ready}
+    for port in READY_PORTS:
+        checks[f"broker_{port}"] = lambda port=port: (None if _core().probe_port(host, port, timeout=timeout)['reachable']
+                                                      else f"port {port}: not accepting connections")
+    return checks
+
+def _wait_ready(host, deadline=RESTART_DEADLINE, timeout=None):
+    """
+    Wait until the proxy is ready. The checks that are not ready yet are executed at the same time and
+    repeated with exponential backoff, until all are ready or the deadline has passed.
+
+    :param host: fqdn of the proxy
+    :param deadline: maximum number of seconds to wait
+    :param timeout: timeout in seconds for every check. Default is ProxyCore.probe_timeout
+    :return: dict with ready, the duration, the number of attempts and the errors of the checks not ready
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    pending = _readiness_checks(host, timeout or _core().probe_timeout)
+    delay = READY_BACKOFF_START
+    attempts = 0
+    while True:
+        attempts += 1
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            # every thread gets a copy of the context, so __salt__ is available in the checks
+            futures = {name: executor.submit(contextvars.copy_context().run, check)
+                       for name, check in pending.items()}
+        errors = {name: future.result() for name, future in futures.items() if future.result()}
+        pending = {name: check for name, check in pending.items() if name in errors}
+        duration = time.monotonic() - start_time
+        if not pending or duration >= deadline:
+            return {'ready': not pending, 'duration': round(duration, 3), 'attempts': attempts, 'errors': errors}
+        log.debug(f"Proxy not ready after {duration:.1f}s: {', '.join(errors.values())}")
+        time.sleep(min(delay, deadline - duration))
+        delay = min(delay * 2, READY_BACKOFF_MAX)
+
+@_exclusive("restart")
+@_recorded("restart")
+def restart(wait=False, deadline=RESTART_DEADLINE):
     """
     Restart the SMLM proxy.
 
     example: salt '<fqdn>' smlm_proxy.restart
+             salt '<fqdn>' smlm_proxy.restart wait=True deadline=120
 
+    :param wait: When True, the proxy is stopped and started and the command waits until https, the salt broker
+                 and squid are ready. The result contains the time to stop, the time until ready and the downtime
+    :param deadline: maximum number of seconds to wait until the proxy is ready
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy restart'
-        return _execute_command(cmd)
+        if not wait:
+            cmd = ["mgrpxy", "restart"]
+            return _execute_command(cmd)
+        start_time = time.monotonic()
+        result = _execute_command(["mgrpxy", "stop"])
+        time_to_stop = round(time.monotonic() - start_time, 3)
+        if not result['success']:
+            return dict(result, time_to_stop=time_to_stop)
+        start_ready = time.monotonic()
+        result = _execute_command(["mgrpxy", "start"])
+        if not result['success']:
+            return dict(result, time_to_stop=time_to_stop)
+        ready = _wait_ready(__salt__['grains.get']('fqdn'), deadline=float(deadline))
+        ret = {'success': ready['ready'], 'time_to_stop': time_to_stop,
+               'time_to_ready': round(time.monotonic() - start_ready, 3),
+               'downtime': round(time.monotonic() - start_time, 3), 'attempts': ready['attempts']}
+        if ready['ready']:
+            ret['message'] = f"SMLM Proxy restarted and ready after {ret['downtime']}s"
+        else:
+            ret['message'] = (f"SMLM Proxy not ready within {deadline}s: "
+                              f"{', '.join(ready['errors'].values())}")
+            ret['errors'] = ready['errors']
+            log.error(ret['message'])
+        return ret
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
         log.error(ret['message'])
         return ret
 
-def clearcaches():
+def probe(ports=None, samples=3, timeout=None):
+    """
+    Check the connectivity of the proxy to SMLM. The ports are tested at the same time, every port with the
+    given number of connections. For port 443 the TLS handshake is measured as well.
+
+    example: salt '<fqdn>' smlm_proxy.probe
+             salt '<fqdn>' smlm_proxy.probe ports=443,4505 samples=5 timeout=1
+
+    :param ports: list or comma separated string of ports. Default is 443, 4505 and 4506
+    :param samples: number of connections per port
+    :param timeout: timeout in seconds for every connect and TLS handshake. Default is 3
+    :return: dict with per port if it is reachable and the percentiles of the connect and TLS handshake times
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    timeout = float(timeout) if timeout else _core().probe_timeout
+    smlm = __salt__['grains.get']('master')
+    if ports is None:
+        ports = PROBE_PORTS
+    elif isinstance(ports, str):
+        ports = [port for port in ports.split(",") if port.strip()]
+    elif not isinstance(ports, (list, tuple, set)):
+        # the salt command line passes ports=443 as int
+        ports = [ports]
+    try:
+        ports = [int(port) for port in ports]
+    except (TypeError, ValueError):
+        ret = {'success': False, 'message': f"Invalid ports {ports}, use a comma separated list of port numbers"}
+        log.error(ret['message'])
+        return ret
+    with ThreadPoolExecutor(max_workers=len(ports) or 1) as executor:
+        futures = {port: executor.submit(_core().probe_port, smlm, port, samples=int(samples), timeout=timeout,
+                                         tls=port == 443) for port in ports}
+    results = {port: future.result() for port, future in futures.items()}
+    unreachable = [str(port) for port, result in results.items() if not result['reachable']]
+    if unreachable:
+        ret = {'success': False, 'message': f"Port(s) {', '.join(unreachable)} of {smlm} not reachable"}
+        log.error(ret['message'])
+    else:
+        ret = {'success': True, 'message': f"All ports of {smlm} reachable"}
+    ret.update({'master': smlm, 'ports': results, 'duration': round(time.monotonic() - start_time, 3)})
+    return ret
+
+def _image_digest(reference):
+    """
+    Get the digest of a local image, see ProxyCore.image_digest().
+    :return: digest, or None when the image is not present
+    """
+    return _core().image_digest(reference)
+
+def _tag_image(reference, tag):
+    """
+    Tag an image referenced by its digest, as mgrpxy install references the images by their tag.
+
+    :param reference: image reference with digest
+    :param tag: tag of the images
+    :return: error, or None when the image is tagged
+    """
+    ret = _execute_command(["podman", "tag", reference, f"{reference.split('@')[0]}:{tag}"])
+    if not ret['success']:
+        return ret['error'] or f"Unable to tag {reference}"
+    return None
+
+def pull_images(tag=None, registry=None, digests=None, workers=3, test=False):
+    """
+    Pull the container images of the proxy before installing or upgrading, so the downtime doesn't include
+    the download. Images that are already present are not pulled. The images are pulled in parallel.
+    install passes the same registry and tag to mgrpxy, and doesn't pull when all images are present.
+
+    example: salt '<fqdn>' smlm_proxy.pull_images
+             salt '<fqdn>' smlm_proxy.pull_images tag=5.1.0 workers=5
+
+    :param tag: tag of the images. Default is the pillar value proxy:tag or the default of the installed mgrpxy
+    :param registry: registry and path of the images, without the cpu architecture. Default is the pillar value
+                     proxy:registry or the default of the installed mgrpxy
+    :param digests: dict with the expected digest (sha256:...) per image name, e.g. proxy-httpd. The images are
+                    pulled by digest, verified after pulling and tagged with the tag
+    :param workers: number of images pulled at the same time
+    :param test: When True, only check which images would be pulled
+    :return: dict with per image the reference, the digest and if it was pulled
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    digests = digests or {}
+    registry, tag, err = _core().image_settings(registry=registry, tag=tag)
+    if err:
+        ret = {'success': False, 'message': err}
+        log.error(ret['message'])
+        return ret
+    references = _core().image_references(registry, tag, digests)
+    # the threads use __salt__, so every task runs in a copy of the context of this thread
+    with ThreadPoolExecutor(max_workers=len(references)) as executor:
+        futures = {image: executor.submit(contextvars.copy_context().run, _image_digest, reference)
+                   for image, reference in references.items()}
+        present = {image: future.result() for image, future in futures.items()}
+    images = {image: {'reference': reference, 'digest': present[image], 'pulled': False}
+              for image, reference in references.items()}
+    missing = [image for image, digest in present.items() if digest is None]
+    if not test:
+        errors = [_tag_image(references[image], tag) for image in digests if present.get(image)]
+        if any(errors):
+            ret = {'success': False, 'message': "\n".join(error for error in errors if error), 'images': images}
+            log.error(ret['message'])
+            return ret
+    if test or not missing:
+        return {'success': True, 'message': f"{len(missing)} images would be pulled" if test else
+                "All images present", 'images': images, 'missing': missing,
+                'duration': round(time.monotonic() - start_time, 3)}
+
+    def _pull(image):
+        ret = _execute_command(["podman", "pull", "--quiet", references[image]])
+        if not ret['success']:
+            return ret['error'] or f"Unable to pull {references[image]}"
+        digest = _image_digest(references[image])
+        if digests.get(image):
+            if digest != digests[image]:
+                return f"Digest of {references[image]} is {digest}, expected {digests[image]}"
+            error = _tag_image(references[image], tag)
+            if error:
+                return error
+        images[image].update({'digest': digest, 'pulled': True})
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _pull, image) for image in missing]
+        errors = [error for error in (future.result() for future in futures) if error]
+    ret = {'success': not errors, 'images': images, 'missing': [image for image in missing
+                                                               if not images[image]['pulled']],
+           'duration': round(time.monotonic() - start_time, 3)}
+    if errors:
+        ret['message'] = "\n".join(errors)
+        log.error(ret['message'])
+    else:
+        ret['message'] = f"{len(missing)} images pulled"
+    return ret
+
+class _RateLimiter:
+    """
+    Token bucket shared by the threads downloading files, limiting the total bandwidth.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - size
+            self.last = now
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class _WarmProgress:
+    """
+    Counters of a running cache warm-up, shared by the download threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, size, error=False):
+        with self.lock:
+            self.files += int(not error)
+            self.bytes += size
+            self.errors += int(error)
+            if (self.files + self.errors) % WARM_PROGRESS_INTERVAL == 0:
+                log.info(f"Warming proxy cache: {self.files} files, {self.bytes} bytes, {self.errors} errors")
+
+def _warm_channels(client, session, proxy_name, channels=None):
+    """
+    Get the software channels of the clients of this proxy.
+
+    :param client: SMLM API client
+    :param session: SMLM API session
+    :param proxy_name: fqdn of the proxy
+    :param channels: list of channel labels to limit the result to
+    :return: list of channel labels
+    """
+    systems = client.system.getId(session, proxy_name)
+    if not systems:
+        raise ValueError(f"Proxy {proxy_name} is not registered in SMLM")
+    proxy_clients = set(client.proxy.listProxyClients(session, systems[0]['id']))
+    labels = []
+    for channel in client.channel.listSoftwareChannels(session):
+        if channels and channel['label'] not in channels:
+            continue
+        subscribed = client.channel.software.listSubscribedSystems(session, channel['label'])
+        if any(system['id'] in proxy_clients for system in subscribed):
+            labels.append(channel['label'])
+    return labels
+
+def _warm_urls(client, session, label, base_url, packages=True):
+    """
+    Generate the urls of the repository metadata and the latest packages of a channel.
+
+    :param client: SMLM API client
+    :param session: SMLM API session
+    :param label: channel label
+    :param base_url: url of the proxy
+    :param packages: When True, the urls of the packages are generated as well
+    :return: generator of urls
+    """
+    channel_url = f"{base_url.rstrip('/')}{DOWNLOAD_PATH}/{urllib.parse.quote(label)}"
+    yield f"{channel_url}/repodata/repomd.xml"
+    if packages:
+        for package in client.channel.software.listLatestPackages(session, label):
+            filename = f"{package['name']}-{package['version']}-{package['release']}.{package['arch_label']}.rpm"
+            yield f"{channel_url}/getPackage/{urllib.parse.quote(filename)}"
+
+def _warm_url(url, context, headers, limiter, progress, timeout):
+    """
+    Download a url through the proxy, so it is stored in the squid cache. The content is not kept.
+    For repomd.xml, the urls of the metadata files it refers to are returned.
+
+    :return: list of urls found in repomd.xml
+    """
+    import urllib.request
+    import xml.etree.ElementTree
+    size = 0
+    found = []
+    try:
+        request = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(request, context=context, timeout=timeout) as response:
+            repomd = bytearray() if url.endswith("/repodata/repomd.xml") else None
+            for block in iter(lambda: response.read(65536), b""):
+                size += len(block)
+                limiter.consume(len(block))
+                if repomd is not None:
+                    repomd += block
+        if repomd is not None:
+            base = url.rsplit("/repodata/", 1)[0]
+            for location in xml.etree.ElementTree.fromstring(bytes(repomd)).iter():
+                if location.tag.endswith("location") and location.get('href'):
+                    found.append(f"{base}/{location.get('href')}")
+    except Exception as e:
+        log.debug(f"Unable to download {url}: {e}")
+        progress.add(size, error=True)
+        return found
+    progress.add(size)
+    return found
+
+def warm_cache(channels=None, packages=True, workers=4, max_rate=0, base_url=None, token=None):
+    """
+    Fill the squid cache of the SMLM proxy with the repository metadata and the latest packages of the
+    channels used by the clients of the proxy. The files are downloaded through the proxy itself.
+
+    example: salt '<fqdn>' smlm_proxy.warm_cache
+             salt '<fqdn>' smlm_proxy.warm_cache channels=sle-product-sles15-sp6-pool-x86_64 max_rate=10485760
+
+    :param channels: list or comma separated string of channel labels. Default is all channels of the clients
+    :param packages: When False, only the repository metadata is downloaded
+    :param workers: number of files downloaded at the same time
+    :param max_rate: maximum total download rate in bytes per second. 0 is unlimited
+    :param base_url: url of the proxy. Default is https://<fqdn of the proxy>
+    :param token: download token send as X-Mgr-Auth header. Default is the pillar value proxy:download_token
+    :return: dict with the channels, the number of files and the bytes downloaded
+    """
+    import ssl
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    if isinstance(channels, str):
+        channels = [channel.strip() for channel in channels.split(",") if channel.strip()]
+    proxy_name = __salt__['grains.get']('fqdn')
+    base_url = base_url or f"https://{proxy_name}"
+    token = token or __salt__['pillar.get']('proxy:download_token')
+    headers = {'X-Mgr-Auth': token} if token else {}
+    root_crt = __salt__['pillar.get']('proxy:root_crt')
+    context = ssl.create_default_context(cadata=root_crt or None) if base_url.startswith("https") else None
+
+    err, client, session = _login_smlm()
+    if err:
+        return {'success': False, 'message': err}
+    read_timeout = _core().read_timeout
+    limiter = _RateLimiter(int(max_rate))
+    progress = _WarmProgress()
+    # limit the number of queued downloads, so the queue doesn't grow with the number of packages
+    slots = threading.BoundedSemaphore(int(workers) * 2)
+    try:
+        labels = _warm_channels(client, session, proxy_name, channels)
+
+        def _submit(executor, url):
+            slots.acquire()
+            future = executor.submit(_warm_url, url, context, headers, limiter, progress, read_timeout)
+            future.add_done_callback(lambda _: slots.release())
+            return future
+
+        with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+            for label in labels:
+                for url in _warm_urls(client, session, label, base_url, packages=packages):
+                    future = _submit(executor, url)
+                    if url.endswith("/repodata/repomd.xml"):
+                        # the metadata files are only known after repomd.xml is downloaded
+                        for metadata_url in future.result():
+                            _submit(executor, metadata_url)
+    except Exception as e:
+        ret = {'success': False, 'message': f"Unable to warm the proxy cache: {e}"}
+        log.error(ret['message'])
+        return ret
+    finally:
+        _logout_smlm()
+
+    ret = {'success': progress.errors == 0, 'channels': labels, 'files': progress.files,
+           'bytes_warmed': progress.bytes, 'errors': progress.errors,
+           'duration': round(time.monotonic() - start_time, 3)}
+    ret['message'] = (f"Proxy cache warmed with {progress.files} files ({progress.bytes} bytes) of "
+                      f"{len(labels)} channels")
+    if progress.errors:
+        ret['message'] += f", {progress.errors} files could not be downloaded"
+        log.error(ret['message'])
+    return ret
+
+class _PurgeProgress:
+    """
+    Counters of a running purge, shared by the worker threads. When running as job, the bytes freed are reported
+    to the job. The percentage is estimated with the size of the cache in the index of cache_stats.
+    """
+    def __init__(self, job=None, expected_bytes=0):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.next_report = PURGE_PROGRESS_INTERVAL
+        self.job = job
+        self.expected_bytes = expected_bytes
+
+    def add(self, files, freed, errors):
+        with self.lock:
+            self.files += files
+            self.bytes += freed
+            self.errors += errors
+            if self.files >= self.next_report:
+                self.next_report += PURGE_PROGRESS_INTERVAL
+                log.info(f"Clearing proxy cache: {self.files} files removed, {self.bytes} bytes freed")
+            freed_total = self.bytes
+        if self.job is not None:
+            percent = min(99, round(100 * freed_total / self.expected_bytes)) if self.expected_bytes else None
+            self.job.update("purge", percent, freed_total)
+
+def _remove_file(path, entry=None):
+    """
+    Remove a single file or symlink.
+
+    :param path: path of the file
+    :param entry: os.DirEntry of the file, when available. Saves an extra stat call.
+    :return: number of bytes freed
+    """
+    st = entry.stat(follow_symlinks=False) if entry is not None else os.lstat(path)
+    os.unlink(path)
+    return st.st_blocks * 512
+
+def _purge_tree(path, progress, remove_root=True):
+    """
+    Remove the content of a directory tree with os.scandir. The tree is walked depth first, so only the
+    directories of the current branch are kept in memory, regardless of the number of files.
+
+    :param path: directory to purge
+    :param progress: _PurgeProgress to update
+    :param remove_root: When True, path itself is removed as well
+    :return:
+    """
+    files = freed = errors = 0
+    stack = [(path, False)]
+    while stack:
+        directory, visited = stack.pop()
+        if visited:
+            if directory != path or remove_root:
+                try:
+                    os.rmdir(directory)
+                except OSError as e:
+                    log.debug(f"Unable to remove {directory}: {e}")
+                    errors += 1
+            continue
+        stack.append((directory, True))
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, False))
+                            continue
+                        freed += _remove_file(entry.path, entry)
+                        files += 1
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        log.debug(f"Unable to remove {entry.path}: {e}")
+                        errors += 1
+                    if files >= 1000:
+                        progress.add(files, freed, errors)
+                        files = freed = errors = 0
+        except OSError as e:
+            log.debug(f"Unable to read {directory}: {e}")
+            errors += 1
+    progress.add(files, freed, errors)
+
+def _purge_directory(path, workers=8, expected_bytes=None):
+    """
+    Remove the content of the given directory, but not the directory itself. The subtrees on PURGE_SPLIT_DEPTH
+    are removed in parallel by a bounded thread pool.
+
+    :param path: directory to purge
+    :param workers: number of threads removing files
+    :param expected_bytes: size of the directory, to estimate the progress of a job. Default is the size of the
+                           squid cache in the index of cache_stats
+    :return: dict with files removed, bytes freed, errors and duration
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    job = _core().running_job()
+    if expected_bytes is None:
+        expected_bytes = _cache_index_bytes() if job else 0
+    progress = _PurgeProgress(job, expected_bytes)
+    # limit the number of queued subtrees, so the queue doesn't grow with the size of the cache
+    slots = threading.BoundedSemaphore(workers * 2)
+    removable_dirs = []
+
+    def _submit(executor, subtree):
+        slots.acquire()
+        # the progress of a job is sent as event with __salt__, which needs the context of the loader
+        future = executor.submit(contextvars.copy_context().run, _purge_tree, subtree, progress)
+        future.add_done_callback(lambda _: slots.release())
+
+    def _walk(executor, directory, depth):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth + 1 >= PURGE_SPLIT_DEPTH:
+                            _submit(executor, entry.path)
+                        else:
+                            _walk(executor, entry.path, depth + 1)
+                            removable_dirs.append(entry.path)
+                        continue
+                    progress.add(1, _remove_file(entry.path, entry), 0)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    log.debug(f"Unable to remove {entry.path}: {e}")
+                    progress.add(0, 0, 1)
+
+    if os.path.isdir(path):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            _walk(executor, path, 0)
+        # the upper directories are empty now that all subtrees are removed
+        for directory in reversed(removable_dirs):
+            try:
+                os.rmdir(directory)
+            except OSError as e:
+                log.debug(f"Unable to remove {directory}: {e}")
+                progress.add(0, 0, 1)
+
+    return {'files_removed': progress.files, 'bytes_freed': progress.bytes, 'errors': progress.errors,
+            'duration': round(time.monotonic() - start_time, 3)}
+
+def _low_priority_purge(path, workers=8, expected_bytes=None):
+    """
+    Remove the given directory completely with idle I/O priority and the lowest CPU priority. The priorities are
+    set on a dedicated thread, so only this thread and the worker threads created by it are affected.
+
+    :param path: directory to remove
+    :param workers: number of threads removing files
+    :param expected_bytes: size of the directory, to estimate the progress of a job
+    :return: dict with files removed, bytes freed, errors and duration
+    """
+    result = {}
+
+    def _run():
+        thread_id = threading.get_native_id()
+        __salt__['cmd.run_all'](["ionice", "-c", "3", "-p", str(thread_id)], python_shell=False, ignore_retcode=True)
+        try:
+            os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+        except OSError as e:
+            log.debug(f"Unable to lower the CPU priority: {e}")
+        result.update(_purge_directory(path, workers=workers, expected_bytes=expected_bytes))
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            log.debug(f"Unable to remove {path}: {e}")
+            result['errors'] += 1
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(_run,), name="smlm-proxy-purge")
+    thread.start()
+    thread.join()
+    return result
+
+def _swap_cache_dir(path):
+    """
+    Move the cache directory aside and create a new, empty one with the same ownership, mode and SELinux context.
+    When the new directory can't be created, the old cache directory is moved back.
+
+    :param path: cache directory
+    :return: error and the path of the old cache directory. On error, the path is only returned when the old
+             cache directory could not be moved back, so path is missing.
+    """
+    old_path = f"{path}.purge-{time.strftime('%Y%m%d%H%M%S')}"
+    try:
+        st = os.stat(path)
+        os.rename(path, old_path)
+    except OSError as e:
+        return f"Unable to move the proxy cache aside: {e}", None
+    try:
+        os.mkdir(path)
+        os.chown(path, st.st_uid, st.st_gid)
+        os.chmod(path, st.st_mode & 0o7777)
+    except OSError as e:
+        err = f"Unable to create a new proxy cache directory: {e}"
+        try:
+            if os.path.isdir(path):
+                os.rmdir(path)
+            os.rename(old_path, path)
+        except OSError as restore_error:
+            return f"{err}. Unable to move {old_path} back to {path}: {restore_error}", old_path
+        return err, None
+    try:
+        os.setxattr(path, "security.selinux", os.getxattr(old_path, "security.selinux"))
+    except OSError as e:
+        # no SELinux context present, or SELinux is not supported on this filesystem
+        log.debug(f"SELinux context not copied to {path}: {e}")
+    return None, old_path
+
+def _clearcaches_swap(workers=8, background=False):
+    """
+    Clear the cache of the proxy with minimal downtime. The proxy is only stopped while the cache directory
+    is replaced by an empty one. The old cache is removed after the proxy is started again.
+
+    :param workers: number of threads removing the files of the old cache
+    :param background: When True, the old cache is removed by a background process
+    :return:
+    """
+    start_time = time.monotonic()
+    _core().job_progress("stop", 0, force=True)
+    result = _execute_command(["mgrpxy", "stop"])
+    if not result['success']:
+        return result
+    expected_bytes = _cache_index_bytes()
+    err, old_path = _swap_cache_dir(SQUID_CACHE_DIR)
+    if not err:
+        _reset_cache_index()
+    if err and old_path:
+        # the squid volume has no cache directory, the proxy is not started on it
+        ret = {'success': False, 'message': f"{err}. The proxy is not started"}
+        log.error(ret['message'])
+        return ret
+    _core().job_progress("start", 1, force=True)
+    result = _execute_command(["mgrpxy", "start"])
+    downtime = round(time.monotonic() - start_time, 3)
+    if err:
+        ret = {'success': False, 'message': err, 'downtime': downtime}
+        log.error(ret['message'])
+        return ret
+    if not result['success']:
+        result['downtime'] = downtime
+        return result
+    log.info(f"Proxy cache swapped, proxy was down for {downtime} seconds")
+
+    ret = {'success': True, 'message': "cache of proxy cleared", 'downtime': downtime}
+    if background:
+        job = __salt__['cmd.run_bg'](["ionice", "-c", "3", "nice", "-n", "19", "rm", "-rf", "--one-file-system",
+                                      old_path], python_shell=False)
+        ret.update({'message': f"cache of proxy cleared, {old_path} is removed in the background",
+                    'reclaim_pid': job.get('pid')})
+        return ret
+    purge = _low_priority_purge(old_path, workers=workers, expected_bytes=expected_bytes)
+    ret.update(purge)
+    ret['reclaim_duration'] = purge.pop('duration')
+    ret['duration'] = round(time.monotonic() - start_time, 3)
+    if purge['errors']:
+        ret.update({'success': False, 'message': f"cache of proxy cleared, but {purge['errors']} entries of "
+                                                 f"{old_path} could not be removed"})
+        log.error(ret['message'])
+    return ret
+
+def _escape_label(value):
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _prometheus_metric(name, metric_type, description, samples):
+    """
+    Format a metric in the Prometheus text format.
+
+    :param name: name of the metric
+    :param metric_type: gauge or counter
+    :param description: help text
+    :param samples: list of tuples with a dict of labels and the value
+    :return: list of lines
+    """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+def metrics(textfile=None):
+    """
+    Get the health of the proxy and its cache in the Prometheus text format. The collection doesn't run
+    'mgrpxy status' and doesn't scan the cache, so it can be scheduled every few seconds. The size of the cache
+    is taken from the index written by cache_stats.
+
+    When a textfile is given, the metrics are written to it for the textfile collector of the node exporter.
+
+    example: salt '<fqdn>' smlm_proxy.metrics
+             salt '<fqdn>' smlm_proxy.metrics textfile=/var/lib/node_exporter/textfile_collector/smlm_proxy.prom
+
+    :param textfile: file to write the metrics to. Default is the pillar value proxy:metrics_textfile
+    :return: dict with the metrics
+    """
+    lines = []
+    containers = _core().containers_status(images=False)
+    lines += _prometheus_metric("smlm_proxy_container_up", "gauge", "1 when the container unit is active.",
+                                [({'container': name}, int(container['active'] == 'active'))
+                                 for name, container in containers.items()])
+    lines += _prometheus_metric("smlm_proxy_container_restarts_total", "counter",
+                                "Number of restarts of the container unit by systemd.",
+                                [({'container': name}, container['restarts']) for name, container in containers.items()])
+
+    index_file = _cache_index_path()
+    index = _load_cache_index(index_file)
+    if index:
+        lines += _prometheus_metric("smlm_proxy_cache_bytes", "gauge",
+                                    "Bytes used by the squid cache at the last run of cache_stats or clearcaches.",
+                                    [({}, sum(entry['b'] for entry in index.values()))])
+        lines += _prometheus_metric("smlm_proxy_cache_index_timestamp_seconds", "gauge",
+                                    "Time of the last run of cache_stats or clearcaches.", [({}, round(os.path.getmtime(index_file)))])
+    max_cache, err = _core().max_cache()
+    if not err:
+        lines += _prometheus_metric("smlm_proxy_cache_max_bytes", "gauge",
+                                    "Configured maximum size of the squid cache.", [({}, max_cache * 1024 * 1024)])
+    try:
+        volume = os.statvfs(SQUID_CACHE_DIR)
+        lines += _prometheus_metric("smlm_proxy_cache_volume_free_bytes", "gauge",
+                                    "Free bytes on the filesystem of the squid cache.",
+                                    [({}, volume.f_bavail * volume.f_frsize)])
+        lines += _prometheus_metric("smlm_proxy_cache_volume_size_bytes", "gauge",
+                                    "Size of the filesystem of the squid cache.",
+                                    [({}, volume.f_blocks * volume.f_frsize)])
+    except OSError:
+        pass
+
+    operations = _load_operations()
+    for name, field_name, description in (
+            ("smlm_proxy_last_operation_duration_seconds", 'duration', "Duration of the last operation."),
+            ("smlm_proxy_last_operation_success", 'success', "1 when the last operation was successful."),
+            ("smlm_proxy_last_operation_timestamp_seconds", 'timestamp', "End time of the last operation.")):
+        lines += _prometheus_metric(name, "gauge", description,
+                                    [({'operation': operation}, int(values[field_name]) if field_name == 'success'
+                                      else values[field_name]) for operation, values in sorted(operations.items())])
+    text = "\n".join(lines) + "\n"
+
+    textfile = textfile or __salt__['pillar.get']('proxy:metrics_textfile')
+    if textfile:
+        # the collector may read the file at any moment, so it is replaced atomically
+        try:
+            with open(f"{textfile}.tmp", 'w') as f:
+                f.write(text)
+            os.replace(f"{textfile}.tmp", textfile)
+        except OSError as e:
+            ret = {'success': False, 'message': f"Unable to write {textfile}: {e}"}
+            log.error(ret['message'])
+            return ret
+        return {'success': True, 'message': f"Metrics written to {textfile}", 'metrics': text}
+    return {'success': True, 'message': "Metrics collected", 'metrics': text}
+
+def _squid_access_log():
+    """
+    Get the path of the squid access log by mounting the root filesystem of the squid container.
+    :return: error and the path of the access log
+    """
+    ret = __salt__['cmd.run_all'](["podman", "mount", SQUID_CONTAINER], python_shell=False, ignore_retcode=True)
+    if ret['retcode'] != 0 or not ret['stdout'].strip():
+        return f"Unable to find the filesystem of container {SQUID_CONTAINER}: {ret['stderr']}", None
+    return None, os.path.join(ret['stdout'].strip(), SQUID_ACCESS_LOG.lstrip("/"))
+
+def _empty_cache_report():
+    """
+    Get the initial state of a cache report.
+    """
+    return {'inode': None, 'offset': 0, 'requests': 0, 'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0,
+            'channels': {}, 'missed_urls': {}}
+
+def _add_log_line(report, line):
+    """
+    Add a line of the squid access log (native format) to the report.
+
+    :param report: report to update
+    :param line: line of the access log
+    """
+    fields = line.split()
+    if len(fields) < 7:
+        return
+    try:
+        size = int(fields[4])
+    except ValueError:
+        return
+    url = fields[6]
+    hit = "HIT" in fields[3].split("/", 1)[0]
+    report['requests'] += 1
+    report['hits' if hit else 'misses'] += 1
+    report['hit_bytes' if hit else 'miss_bytes'] += size
+
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith(DOWNLOAD_PATH + "/"):
+        label = path[len(DOWNLOAD_PATH) + 1:].split("/", 1)[0]
+        channel = report['channels'].setdefault(label, {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0})
+        channel['hits' if hit else 'misses'] += 1
+        channel['hit_bytes' if hit else 'miss_bytes'] += size
+    if not hit:
+        missed = report['missed_urls']
+        missed[url] = missed.get(url, 0) + 1
+        if len(missed) > 2 * CACHE_REPORT_TRACKED_URLS:
+            # keep the most missed urls. The counts of urls added later are lower bounds
+            kept = sorted(missed.items(), key=lambda item: item[1], reverse=True)[:CACHE_REPORT_TRACKED_URLS]
+            report['missed_urls'] = dict(kept)
+
+def cache_report(log_file=None, top=20, reset=False):
+    """
+    Analyze the squid access log of the proxy: the hit ratio, the bytes served from the cache and from SMLM,
+    the most missed urls and the numbers per channel. The log is read as a stream from the position reached by
+    the previous call, which is stored with the results in the cache directory of the minion.
+
+    example: salt '<fqdn>' smlm_proxy.cache_report
+             salt '<fqdn>' smlm_proxy.cache_report top=50 reset=True
+
+    :param log_file: path of the access log. Default is /var/log/squid/access.log in the squid container
+    :param top: number of most missed urls returned
+    :param reset: When True, the stored results are discarded and the log is read from the start
+    :return: dict with the totals since the first call, or since the last reset
+    """
+    start_time = time.monotonic()
+    if not log_file:
+        err, log_file = _squid_access_log()
+        if err:
+            log.error(err)
+            return {'success': False, 'message': err}
+    report_file = os.path.join(__opts__['cachedir'], CACHE_REPORT_FILE)
+    report = _empty_cache_report()
+    if not reset:
+        try:
+            with open(report_file, 'r') as f:
+                report.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    new_lines = 0
+    try:
+        with open(log_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if report['inode'] != st.st_ino or st.st_size < report['offset']:
+                # the log was rotated or truncated
+                report['inode'] = st.st_ino
+                report['offset'] = 0
+            f.seek(report['offset'])
+            remainder = b""
+            for block in iter(lambda: f.read(1048576), b""):
+                lines = (remainder + block).split(b"\n")
+                # the last line may be incomplete, it is read again with the next block or the next call
+                remainder = lines.pop()
+                for line in lines:
+                    _add_log_line(report, line.decode('utf-8', errors='replace'))
+                    report['offset'] += len(line) + 1
+                    new_lines += 1
+    except OSError as e:
+        ret = {'success': False, 'message': f"Unable to read {log_file}: {e}"}
+        log.error(ret['message'])
+        return ret
+
+    try:
+        os.makedirs(os.path.dirname(report_file), exist_ok=True)
+        with open(f"{report_file}.tmp", 'w') as f:
+            json.dump(report, f, separators=(',', ':'))
+        os.replace(f"{report_file}.tmp", report_file)
+    except OSError as e:
+        log.warning(f"Unable to store the cache report {report_file}: {e}")
+
+    total_bytes = report['hit_bytes'] + report['miss_bytes']
+    top_missed = sorted(report['missed_urls'].items(), key=lambda item: item[1], reverse=True)[:int(top)]
+    channels = {label: dict(values, hit_ratio=round(values['hits'] / max(1, values['hits'] + values['misses']), 3))
+                for label, values in report['channels'].items()}
+    hit_ratio = round(report['hits'] / report['requests'], 3) if report['requests'] else None
+    return {'success': True, 'message': f"Cache hit ratio {hit_ratio} over {report['requests']} requests",
+            'requests': report['requests'], 'hits': report['hits'], 'misses': report['misses'],
+            'hit_ratio': hit_ratio, 'bytes_from_cache': report['hit_bytes'], 'bytes_from_upstream': report['miss_bytes'],
+            'byte_hit_ratio': round(report['hit_bytes'] / total_bytes, 3) if total_bytes else None,
+            'top_missed_urls': [{'url': url, 'misses': count} for url, count in top_missed],
+            'channels': channels, 'new_lines': new_lines, 'duration': round(time.monotonic() - start_time, 3)}
+
+def _cache_index_path():
+    """
+    Get the location of the index of the squid cache in the cache directory of the minion.
+    :return:
+    """
+    return os.path.join(__opts__['cachedir'], CACHE_INDEX_FILE)
+
+def _load_cache_index(path):
+    """
+    Load the index of the squid cache written by a previous call of cache_stats.
+
+    :param path: location of the index
+    :return: dict with per directory the collected statistics
+    """
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    return index
+
+def _save_cache_index(path, index):
+    """
+    Write the index of the squid cache. The file is replaced atomically.
+
+    :param path: location of the index
+    :param index: dict with per directory the collected statistics
+    :return:
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log.warning(f"Unable to write the proxy cache index {path}: {e}")
+
+def _cache_index_bytes():
+    """
+    Get the size of the squid cache in the index of cache_stats.
+    :return: bytes, 0 when there is no index
+    """
+    return sum(entry.get('b', 0) for entry in _load_cache_index(_cache_index_path()).values())
+
+def _reset_cache_index(cleared=True):
+    """
+    Replace the index of the squid cache after the cache was cleared, so metrics doesn't report the size before
+    the clear until cache_stats is run again. Only the cache directory itself is scanned, its subdirectories are
+    scanned by the next cache_stats.
+
+    :param cleared: When False, the cache was only partly cleared and the index is removed
+    :return:
+    """
+    index_path = _cache_index_path()
+    entry = _scan_cache_dir(SQUID_CACHE_DIR, None)[0] if cleared else None
+    if entry is None:
+        try:
+            os.remove(index_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning(f"Unable to remove the proxy cache index {index_path}: {e}")
+        return
+    _save_cache_index(index_path, {SQUID_CACHE_DIR: entry})
+
+def _size_bucket(size):
+    """
+    Get the position of the given file size in CACHE_SIZE_BUCKETS.
+    """
+    for position, (limit, _) in enumerate(CACHE_SIZE_BUCKETS):
+        if limit is None or size < limit:
+            return position
+
+def _scan_cache_dir(directory, previous):
+    """
+    Collect the statistics of the files directly in the given directory. When the modification time of the
+    directory didn't change since the previous scan, the indexed statistics are reused.
+
+    :param directory: directory to scan
+    :param previous: index entry of the previous scan, or None
+    :return: index entry of the directory and a flag if the directory was rescanned
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        # removed by squid while scanning
+        return None, False
+    if previous and previous.get('m') == mtime:
+        return previous, False
+    entry = {'m': mtime, 'd': [], 'n': 0, 'b': 0, 's': [0] * len(CACHE_SIZE_BUCKETS), 'a': {}}
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return None, False
+    with entries:
+        for dir_entry in entries:
+            try:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    entry['d'].append(dir_entry.name)
+                    continue
+                st = dir_entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entry['n'] += 1
+            entry['b'] += st.st_blocks * 512
+            entry['s'][_size_bucket(st.st_size)] += 1
+            # the age histogram is kept per day, so it stays valid while the directory doesn't change
+            day = str(int(st.st_mtime // 86400))
+            entry['a'][day] = entry['a'].get(day, 0) + 1
+    return entry, True
+
+def cache_stats(workers=8, full=False):
+    """
+    Get the usage of the squid cache of the SMLM proxy: total bytes, number of objects and histograms
+    of the object sizes and ages. The usage is compared to the pillar value proxy:maxcache.
+
+    The directories are scanned in parallel. An index with the statistics per directory is stored in the cache
+    directory of the minion, so the next call only rescans the directories that have changed.
+
+    example: salt '<fqdn>' smlm_proxy.cache_stats
+             salt '<fqdn>' smlm_proxy.cache_stats full=True
+
+    :param workers: number of threads scanning directories
+    :param full: When True, the index is ignored and all directories are scanned
+    :return:
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not os.path.isdir(SQUID_CACHE_DIR):
+        ret = {'success': False, 'message': f"Proxy cache {SQUID_CACHE_DIR} is not present"}
+        log.error(ret['message'])
+        return ret
+    start_time = time.monotonic()
+    index_path = _cache_index_path()
+    previous_index = {} if full else _load_cache_index(index_path)
+    index = {}
+    rescanned = 0
+
+    # the tree is scanned level by level, the directories of one level in parallel
+    level = [SQUID_CACHE_DIR]
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        while level:
+            results = executor.map(lambda d: _scan_cache_dir(d, previous_index.get(d)), level)
+            next_level = []
+            for directory, (entry, changed) in zip(level, results):
+                if entry is None:
+                    continue
+                index[directory] = entry
+                rescanned += int(changed)
+                next_level.extend(os.path.join(directory, name) for name in entry['d'])
+            level = next_level
+    _save_cache_index(index_path, index)
+
+    total_bytes = sum(entry['b'] for entry in index.values())
+    objects = sum(entry['n'] for entry in index.values())
+    size_histogram = {label: sum(entry['s'][position] for entry in index.values())
+                      for position, (_, label) in enumerate(CACHE_SIZE_BUCKETS)}
+    age_histogram = {label: 0 for _, label in CACHE_AGE_BUCKETS}
+    today = int(time.time() // 86400)
+    for entry in index.values():
+        for day, count in entry['a'].items():
+            age = today - int(day)
+            for limit, label in CACHE_AGE_BUCKETS:
+                if limit is None or age < limit:
+                    age_histogram[label] += count
+                    break
+
+    max_cache, err = _core().max_cache()
+    if err:
+        return {'success': False, 'message': err}
+    maxcache_bytes = max_cache * 1024 * 1024
+    usage_percent = round(total_bytes * 100 / maxcache_bytes, 1) if maxcache_bytes else None
+    ret = {'success': True, 'message': f"Proxy cache uses {usage_percent}% of maxcache",
+           'total_bytes': total_bytes, 'objects': objects, 'maxcache_bytes': maxcache_bytes,
+           'usage_percent': usage_percent, 'over_limit': total_bytes > maxcache_bytes,
+           'size_histogram': size_histogram, 'age_histogram': age_histogram,
+           'directories': len(index), 'directories_rescanned': rescanned,
+           'duration': round(time.monotonic() - start_time, 3)}
+    if ret['over_limit']:
+        log.warning(f"Proxy cache uses {total_bytes} bytes, which is more than maxcache ({maxcache_bytes} bytes)")
+    return ret
+
+@_exclusive("clearcaches")
+@_recorded("clearcaches")
+def clearcaches(workers=8, swap=False, background=False, detach=False):
     """
     clear the caches of the SMLM proxy.
 
     example: salt '<fqdn>' smlm_proxy.clearcaches
+             salt '<fqdn>' smlm_proxy.clearcaches workers=16
+             salt '<fqdn>' smlm_proxy.clearcaches swap=True
+             salt '<fqdn>' smlm_proxy.clearcaches detach=True
 
+    :param workers: number of threads removing the files of the squid cache.
+    :param swap: When True, the cache directory is replaced by an empty one and the proxy is started before the
+                 old cache is removed with low I/O priority. The downtime is returned separately.
+    :param background: Only used with swap. When True, the old cache is removed by a background process and
+                       the function returns directly after the proxy is started.
+    :param detach: When True, the caches are cleared by a job and the job id is returned directly, see job_status
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy stop'
-        result = _execute_command(cmd)
-        if not result['success']:
-            return result
-        cmd = 'rm -rf /var/lib/containers/storage/volumes/uyuni-proxy-squid-cache/_data/*'
+        if swap and os.path.isdir(SQUID_CACHE_DIR):
+            return _clearcaches_swap(workers=int(workers), background=background)
+        start_time = time.monotonic()
+        _core().job_progress("stop", 0, force=True)
+        cmd = ["mgrpxy", "stop"]
         result = _execute_command(cmd)
         if not result['success']:
             return result
-        cmd = 'mgrpxy start'
+        purge = _purge_directory(SQUID_CACHE_DIR, workers=int(workers))
+        _reset_cache_index(purge['errors'] == 0)
+        log.info(f"Proxy cache cleared: {purge['files_removed']} files removed, {purge['bytes_freed']} bytes freed "
+                 f"in {purge['duration']} seconds")
+        _core().job_progress("start", 99, purge['bytes_freed'], force=True)
+        cmd = ["mgrpxy", "start"]
         result = _execute_command(cmd)
         if not result['success']:
             return result
+        purge['downtime'] = round(time.monotonic() - start_time, 3)
+        if purge['errors']:
+            ret = {'success': False, 'message': f"cache of proxy partly cleared, {purge['errors']} entries could not "
+                                                f"be removed"}
+            ret.update(purge)
+            log.error(ret['message'])
+            return ret
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
         log.error(ret['message'])
         return ret
-    return {'success': True, 'message': "cache of proxy cleared"}
+    ret = {'success': True, 'message': "cache of proxy cleared"}
+    ret.update(purge)
+    return ret
 
-def install(internet_access=False, install_when_missing=True, cert_self_signed=False):
+def _install(timer, internet_access, install_when_missing):
     """
-    configure the SMLM proxy.
+    Execute the phases of install().
 
-    example: salt '<fqdn>' smlm_proxy.install
-
-    :param internet_access: When True, when server has internet access. The image from register.suse.com will be used.
+    :param timer: PhaseTimer recording the phases
+    :param internet_access: When True, when server has internet access
     :param install_when_missing: When True, software will be installed when missing
-    :param cert_self_signed: When True, self-signed certificate will be used. Currently not implemented!!!!
     :return:
     """
+    # check if the proxy is already running, the pillar data, the software and if SMLM can be reached
+    with timer.phase("preflight") as phase:
+        preflight = _core().preflight(_check_if_active, _proxy_software_installed)
+        if not preflight['success']:
+            phase['outcome'] = "failed"
+            return {'success': False, 'message': "\n".join(preflight['errors']), 'errors': preflight['errors'],
+                    'preflight_timings': preflight['timings']}
+    config = preflight['config']
 
-    # self-signed certificates is currently not supported. Will be added later
-    if cert_self_signed:
-        ret = {'success': False, 'message': "Using self-signed certificate is currently not supported when using"
-                                            "this solution. Please follow the official documentation"}
-        return ret
-
-    # check if proxy is already running
-    ret = _check_if_active()
-    if ret['success']:
-        ret = {'success': False, 'message': "Proxy already running"}
-        return ret
-
-    # configure the proxy
-    ret = _check_parameters()
-    if not ret["success"]:
-        return ret
+    # verify the offline installation bundle, when present
+    bundle = None
+    if config.bundle:
+        with timer.phase("bundle_verify") as phase:
+            err, bundle = _core().verify_bundle(config.bundle)
+            if err:
+                phase['outcome'] = "failed"
+                ret = {'success': False, 'message': err}
+                log.error(ret['message'])
+                return ret
+            phase['bytes'] = _core().file_sizes(bundle['rpms'] + [path for path, _ in bundle['images']])
 
     # check if podman and mgrpxy are installed
     # when install_when_missing is True install the software when missing. Otherwise, write an error.
-    os_finger = __salt__['grains.get']('osfinger')
-    if not _proxy_software_installed():
+    os_finger = preflight['os_finger']
+    if not preflight['software_installed']:
         if install_when_missing:
-            ret = _proxy_software_install(internet_access, os_finger)
+            with timer.phase("software_install") as phase:
+                ret = _core().software_install(internet_access, os_finger, bundle['rpms'] if bundle else None)
+                phase['outcome'] = "success" if ret["success"] else "failed"
+                if bundle:
+                    phase['bytes'] = _core().file_sizes(bundle['rpms'])
             if ret["success"]:
                 if "sle micro" in os_finger.lower():
                     return ret
@@ -323,24 +1519,54 @@ def install(internet_access=False, install_when_missing=True, cert_self_signed=F
             return ret
 
     # configure extra disk
-    ret = _get_config()
+    ret = _core().get_config(config, timer)
+    _logout_smlm()
     if not ret["success"]:
         return ret
     # configure extra disk
 
-    extra_disk, _ = _get_pillar_data("proxy:extradisk", error=False, default_value="")
-    ret = _execute_command(f"mgr-storage-proxy {extra_disk}")
+    with timer.phase("storage") as phase:
+        ret = _execute_command(["mgr-storage-proxy"] + ([config.extra_disk] if config.extra_disk else []))
+        phase['outcome'] = "success" if ret["success"] else "failed"
     if not ret["success"]:
         return ret
 
-    # start the proxy
-    ret = _execute_command("mgrpxy install podman /etc/uyuni/config.tar.gz")
+    # load the container images of the bundle and start the proxy
+    ret = _core().mgrpxy_install(bundle, timer)
     if not ret["success"]:
         return ret
 
-    ret = {'success': True, 'message': "SMLM Proxy successful installed"}
+    ret = {'success': True, 'message': "SMLM Proxy successful installed", 'preflight_timings': preflight['timings']}
     return ret
 
+@_exclusive("install")
+@_recorded("install")
+def install(internet_access=False, install_when_missing=True, cert_self_signed=False, detach=False):
+    """
+    configure the SMLM proxy.
+
+    example: salt '<fqdn>' smlm_proxy.install
+             salt '<fqdn>' smlm_proxy.install detach=True
+
+    :param internet_access: When True, when server has internet access. The image from register.suse.com will be used.
+    :param install_when_missing: When True, software will be installed when missing
+    :param cert_self_signed: When True, self-signed certificate will be used. Currently not implemented!!!!
+    :param detach: When True, the proxy is installed by a job and the job id is returned directly, see job_status
+    :return: the result contains the duration, bytes and outcome per phase under timings
+    """
+
+    # self-signed certificates is currently not supported. Will be added later
+    if cert_self_signed:
+        ret = {'success': False, 'message': "Using self-signed certificate is currently not supported when using"
+                                            "this solution. Please follow the official documentation"}
+        return ret
+
+    timer = _core().phase_timer("install")
+    ret = _install(timer, internet_access, install_when_missing)
+    ret['timings'] = timer.timings
+    return ret
+
+
 
 
 
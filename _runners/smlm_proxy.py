@@ -0,0 +1,471 @@
+# smlm_proxy.py
+# This is a custom Salt Runner module, executed on the SMLM server.
+#
+# To use this module:
+# 1. Place this file in your Salt master's `_runners` directory (e.g., /srv/salt/_runners/).
+# 2. Sync the runners and utils to the master: `salt-run saltutil.sync_all`
+# 3. Generate the configurations before installing the proxies, or restart, clear the caches of or install the
+#    proxies in waves, e.g.:
+#    `salt-run smlm_proxy.generate_configs 'proxy*'`
+#    `salt-run smlm_proxy.rollout 'proxy*' operation=restart batch=10% max_unavailable=5`
+#
+# generate_configs reads the proxy: pillar of every targeted minion, logs in to SMLM once and generates the
+# configurations in batches with system.multicall. The configurations are staged in the pillar of each proxy, with a
+# file_tree ext_pillar, where smlm_proxy.install and smlmproxy.installed pick them up instead of contacting SMLM from
+# the proxy. The master configuration needs:
+#    ext_pillar:
+#      - file_tree:
+#          root_dir: /srv/smlm_proxy/pillar
+#
+# rollout executes an operation on a few proxies at a time and only starts the next wave when the proxies of the
+# previous wave are healthy again, so the clients of a region never lose all proxies at once.
+import contextvars
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "smlm_proxy"
+
+# number of configurations generated with one system.multicall and the number of batches generated at the same time
+GENERATE_BATCH_SIZE = 10
+GENERATE_WORKERS = 4
+MINION_TIMEOUT = 30
+# operations of rollout and the default parameters passed to the execution module
+ROLLOUT_OPERATIONS = {'restart': {'wait': True}, 'clearcaches': {}, 'install': {}}
+ROLLOUT_EVENT_TAG = "smlm_proxy/rollout"
+# the health of a wave is checked with exponential backoff, starting at HEALTH_BACKOFF_START seconds
+HEALTH_BACKOFF_START = 2
+HEALTH_BACKOFF_MAX = 30
+HEALTH_TIMEOUT = 300
+
+def __virtual__():
+    """
+    This function is a Salt convention. It determines if the module should be
+    loaded. Returning True means the module will be loaded.
+    """
+    return __virtualname__
+
+def _core_function(name):
+    """
+    Get a function of the shared smlm_proxy_core utils module.
+    """
+    return __utils__[f'smlm_proxy_core.{name}']
+
+def _minion_configs(tgt, tgt_type):
+    """
+    Load the proxy: pillar of the targeted minions into a ProxyConfig, the same way the minions do.
+
+    :param tgt: target of the proxies
+    :param tgt_type: type of the target
+    :return: dict with per minion the ProxyConfig, and dict with per minion the error
+    """
+    pillars = __salt__['salt.execute'](tgt, 'pillar.get', arg=['proxy'], tgt_type=tgt_type, timeout=MINION_TIMEOUT)
+    grains = __salt__['salt.execute'](tgt, 'grains.item', arg=['fqdn', 'master'], tgt_type=tgt_type,
+                                      timeout=MINION_TIMEOUT)
+    configs = {}
+    errors = {}
+    for minion in sorted(set(pillars) | set(grains)):
+        if not isinstance(pillars.get(minion), dict) or not isinstance(grains.get(minion), dict):
+            errors[minion] = "No pillar or grains returned by the minion"
+            continue
+        minion_pillar = {'proxy': pillars[minion]}
+        minion_grains = grains[minion]
+        salt = {'pillar.get': lambda key, default=None, p=minion_pillar: p.get(key, default),
+                'grains.get': lambda key, default="", g=minion_grains: g.get(key, default)}
+        result = _core_function('core')(salt, __opts__, {}).check_parameters()
+        if result['success']:
+            configs[minion] = result['config']
+        else:
+            errors[minion] = result['error']
+    return configs, errors
+
+def _staging_dir():
+    """
+    Get the root_dir of the file_tree ext_pillar where the configurations are staged.
+    """
+    for ext_pillar in __opts__.get('ext_pillar') or []:
+        if isinstance(ext_pillar, dict) and isinstance(ext_pillar.get('file_tree'), dict):
+            return ext_pillar['file_tree'].get('root_dir')
+    return None
+
+def _stage(root, minion, parameters_hash, data):
+    """
+    Write a configuration to the pillar of a proxy. Configurations staged before for the same minion are
+    removed, as they are outdated and contain the private key of the proxy.
+
+    :param root: root_dir of the file_tree ext_pillar
+    :param minion: id of the proxy minion
+    :param parameters_hash: hash of the parameters of the configuration
+    :param data: content of the configuration file
+    :return: path of the staged file
+    """
+    import base64
+    path = os.path.join(root, _core_function('staged_config_path')(minion, parameters_hash))
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o750, exist_ok=True)
+    for name in os.listdir(directory):
+        if name != os.path.basename(path):
+            os.remove(os.path.join(directory, name))
+    with open(os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640), 'wb') as f:
+        f.write(base64.b64encode(data))
+    os.replace(f"{path}.tmp", path)
+    # the pillar of the master may be compiled by another user than salt-run
+    user = __opts__.get('user')
+    if user and os.geteuid() == 0 and user != "root":
+        import pwd
+        entry = pwd.getpwnam(user)
+        for changed in (os.path.dirname(os.path.dirname(directory)), os.path.dirname(directory), directory, path):
+            os.chown(changed, entry.pw_uid, entry.pw_gid)
+    return path
+
+class _Generator:
+    """
+    Generate the configurations of a group of proxies with one SMLM session. Every worker thread uses its own
+    connection, the batches are sent with system.multicall. When SMLM doesn't support system.multicall, the
+    configurations are requested one by one.
+    """
+    def __init__(self, smlm, session):
+        self.smlm = smlm
+        self.session = session
+        self.multicall = True
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def _client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = _core_function('smlm_client')(self.smlm)
+            with self.lock:
+                self.clients.append(self.local.client)
+        return self.local.client
+
+    def close(self):
+        for client in self.clients:
+            client('close')()
+
+    def _single(self, batch):
+        """
+        Request the configurations of a batch one by one.
+        """
+        results = {}
+        for minion, config in batch:
+            start_time = time.monotonic()
+            try:
+                data = self._client().proxy.container_config(self.session, *config.container_config_parameters())
+                results[minion] = {'data': data.data, 'duration': round(time.monotonic() - start_time, 3)}
+            except Exception as e:
+                results[minion] = {'error': f"Unable to get config file: {e}"}
+        return results
+
+    def generate(self, batch):
+        """
+        Generate the configurations of a batch.
+
+        :param batch: list of minion id and ProxyConfig
+        :return: dict with per minion the content and the generation time, or the error
+        """
+        import xmlrpc.client
+        if not self.multicall:
+            return self._single(batch)
+        start_time = time.monotonic()
+        multicall = xmlrpc.client.MultiCall(self._client())
+        for _, config in batch:
+            multicall.proxy.container_config(self.session, *config.container_config_parameters())
+        try:
+            answers = multicall()
+        except xmlrpc.client.Fault as e:
+            log.warning(f"system.multicall not supported by {self.smlm}, requesting the configurations one by one: {e}")
+            self.multicall = False
+            return self._single(batch)
+        except Exception as e:
+            return {minion: {'error': f"Unable to get config file: {e}"} for minion, _ in batch}
+        duration = round(time.monotonic() - start_time, 3)
+        results = {}
+        for index, (minion, _) in enumerate(batch):
+            try:
+                # with multicall only the time of the complete batch is known
+                results[minion] = {'data': answers[index].data, 'duration': duration}
+            except xmlrpc.client.Fault as e:
+                results[minion] = {'error': f"Unable to get config file: {e.faultString}"}
+        return results
+
+def generate_configs(tgt, tgt_type="glob", batch_size=GENERATE_BATCH_SIZE, workers=GENERATE_WORKERS, force=False,
+                     test=False):
+    """
+    Generate the configuration of the targeted proxies on the SMLM server and stage them in the pillar of each
+    proxy, with the file_tree ext_pillar of the master. smlm_proxy.install and smlmproxy.installed use a staged
+    configuration when it was generated with the current pillar of the proxy, so the proxies don't log in to SMLM
+    themselves. The pillar of the proxies with a new configuration is refreshed.
+
+    example: salt-run smlm_proxy.generate_configs 'proxy*'
+             salt-run smlm_proxy.generate_configs 'G@role:proxy' tgt_type=compound batch_size=20 workers=8
+
+    :param tgt: target of the proxies
+    :param tgt_type: type of the target. Default is glob
+    :param batch_size: number of configurations generated with one system.multicall. Default is 10
+    :param workers: number of batches generated at the same time. Default is 4
+    :param force: When True, configurations that are already staged are generated again
+    :param test: When True, only show which configurations would be generated
+    :return: dict with per proxy the outcome, the size and the generation time of the configuration
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.monotonic()
+    root = _staging_dir()
+    if not root:
+        return {'success': False, 'message': "No file_tree ext_pillar with a root_dir configured on the master"}
+    configs, errors = _minion_configs(tgt, tgt_type)
+    proxies = {minion: {'result': "failed", 'error': error} for minion, error in errors.items()}
+
+    # configurations generated with the current parameters are not generated again
+    pending = {}
+    for minion, config in configs.items():
+        parameters_hash = _core_function('config_hash')(config.container_config_parameters())
+        path = os.path.join(root, _core_function('staged_config_path')(minion, parameters_hash))
+        if os.path.isfile(path) and not force:
+            proxies[minion] = {'result': "staged", 'path': path, 'bytes': os.path.getsize(path)}
+        elif test:
+            proxies[minion] = {'result': "would be generated", 'path': path}
+        else:
+            pending[minion] = (config, parameters_hash)
+
+    # one session per SMLM server and user
+    groups = {}
+    for minion, (config, _) in pending.items():
+        groups.setdefault((config.smlm, config.smlm_cred), []).append((minion, config))
+    logins = 0
+    batches = 0
+    multicall = None
+    for (smlm, smlm_cred), members in groups.items():
+        client = _core_function('smlm_client')(smlm)
+        try:
+            session = _core_function('smlm_login')(client, smlm_cred)
+        except Exception as e:
+            client('close')()
+            for minion, _ in members:
+                proxies[minion] = {'result': "failed", 'error': f"Unable to login to SUSE Manager server {smlm}: {e}"}
+            continue
+        logins += 1
+        generator = _Generator(smlm, session)
+        batch_list = [members[index:index + max(1, int(batch_size))]
+                      for index in range(0, len(members), max(1, int(batch_size)))]
+        batches += len(batch_list)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+                # the workers resolve smlm_client through __utils__, which needs the context of the loader
+                futures = [executor.submit(contextvars.copy_context().run, generator.generate, batch)
+                           for batch in batch_list]
+                for number, future in enumerate(futures, 1):
+                    results = future.result()
+                    for minion, result in results.items():
+                        if 'error' in result:
+                            proxies[minion] = {'result': "failed", 'error': result['error'], 'batch': number}
+                            continue
+                        try:
+                            path = _stage(root, minion, pending[minion][1], result['data'])
+                        except OSError as e:
+                            proxies[minion] = {'result': "failed", 'error': f"Unable to stage the configuration: {e}"}
+                            continue
+                        proxies[minion] = {'result': "generated", 'path': path, 'bytes': len(result['data']),
+                                           'duration': result['duration'], 'batch': number}
+                    log.info(f"smlm_proxy: batch {number} of {len(batch_list)} generated for {smlm}")
+        finally:
+            multicall = generator.multicall if multicall is None else multicall and generator.multicall
+            try:
+                client.auth.logout(session)
+            except Exception as e:
+                log.debug(f"Logout from SUSE Manager server {smlm} failed: {e}")
+            client('close')()
+            generator.close()
+
+    # the proxies only see the new configurations after a refresh of their pillar
+    generated = sorted(minion for minion, proxy in proxies.items() if proxy['result'] == "generated")
+    if generated:
+        refreshed = __salt__['salt.execute'](generated, 'saltutil.refresh_pillar', tgt_type="list",
+                                             kwarg={'wait': True}, timeout=MINION_TIMEOUT)
+        for minion in generated:
+            if not refreshed.get(minion):
+                proxies[minion]['warning'] = "Pillar not refreshed, run saltutil.refresh_pillar before installing"
+
+    failed = sorted(minion for minion, proxy in proxies.items() if proxy['result'] == "failed")
+    ret = {'success': not failed,
+           'message': f"{len(generated)} configurations generated, {len(failed)} failed",
+           'proxies': dict(sorted(proxies.items())), 'logins': logins, 'batches': batches,
+           'duration': round(time.monotonic() - start_time, 3)}
+    if multicall is not None:
+        ret['multicall'] = multicall
+    if failed:
+        ret['failed'] = failed
+    return ret
+
+def _local_client():
+    """
+    Get a client to execute functions on the minions.
+    """
+    import salt.client
+    return salt.client.get_local_client(mopts=__opts__)
+
+def _progress(tag, data):
+    """
+    Send the progress of a rollout as event, and show it in the output of salt-run.
+    """
+    __salt__['event.send'](f"{ROLLOUT_EVENT_TAG}/{tag}", data)
+    jid_event = globals().get('__jid_event__')
+    if jid_event is not None:
+        jid_event.fire_event({'message': data.get('message', tag)}, 'progress')
+
+def _wave_size(batch, total):
+    """
+    Get the number of proxies in a wave, from a number or a percentage of the proxies.
+    """
+    batch = str(batch).strip()
+    if batch.endswith("%"):
+        return max(1, int(total * float(batch[:-1]) / 100))
+    return max(1, int(batch))
+
+def _healthy(minions):
+    """
+    Get the proxies that are running, according to smlm_proxy.status.
+    """
+    if not minions:
+        return set()
+    status = __salt__['salt.execute'](list(minions), 'smlm_proxy.status', tgt_type="list", timeout=MINION_TIMEOUT)
+    return {minion for minion, result in status.items() if isinstance(result, dict) and result.get('success')}
+
+def _wait_healthy(minions, health_timeout):
+    """
+    Wait until the proxies are running again, with exponential backoff.
+
+    :param minions: proxies of the wave
+    :param health_timeout: maximum number of seconds to wait
+    :return: dict with per proxy the seconds until it was healthy, or None when it did not get healthy
+    """
+    start_time = time.monotonic()
+    pending = set(minions)
+    result = {}
+    delay = HEALTH_BACKOFF_START
+    while True:
+        for minion in _healthy(pending):
+            result[minion] = round(time.monotonic() - start_time, 3)
+        pending -= set(result)
+        elapsed = time.monotonic() - start_time
+        if not pending or elapsed >= health_timeout:
+            break
+        time.sleep(min(delay, health_timeout - elapsed))
+        delay = min(delay * 2, HEALTH_BACKOFF_MAX)
+    result.update({minion: None for minion in pending})
+    return result
+
+def _run_wave(minions, operation, kwargs, timeout, number):
+    """
+    Execute the operation on the proxies of a wave. The result of every proxy is sent as event when it
+    returns.
+
+    :return: dict with per proxy the success, message and duration of the operation
+    """
+    start_time = time.monotonic()
+    results = {}
+    for returned in _local_client().cmd_iter(minions, f"smlm_proxy.{operation}", kwarg=kwargs, tgt_type="list",
+                                             timeout=timeout):
+        for minion, data in returned.items():
+            ret = data.get('ret') if isinstance(data, dict) else None
+            success = isinstance(ret, dict) and ret.get('success') is True
+            results[minion] = {'success': success, 'duration': round(time.monotonic() - start_time, 3),
+                               'message': ret.get('message') if isinstance(ret, dict) else str(ret)}
+            _progress(f"{operation}/{minion}", dict(results[minion], minion=minion, wave=number,
+                                                    message=f"wave {number}: {operation} on {minion} "
+                                                            f"{'succeeded' if success else 'failed'} in "
+                                                            f"{results[minion]['duration']}s"))
+    for minion in set(minions) - set(results):
+        results[minion] = {'success': False, 'duration': round(time.monotonic() - start_time, 3),
+                           'message': "No return from the minion"}
+    return results
+
+def rollout(tgt, operation="restart", tgt_type="glob", batch="10%", max_unavailable=None, max_failure_rate=0.1,
+            health_timeout=HEALTH_TIMEOUT, timeout=3600, test=False, **kwargs):
+    """
+    Execute restart, clearcaches or install on the targeted proxies in waves. A wave only starts when the
+    proxies of the previous wave are healthy again. Proxies that are not healthy, before or after the operation,
+    count against max_unavailable. The rollout stops when the failure rate exceeds max_failure_rate.
+    The result of every proxy is sent as event with tag smlm_proxy/rollout/<operation>/<minion>.
+
+    example: salt-run smlm_proxy.rollout 'proxy*'
+             salt-run smlm_proxy.rollout 'proxy*' operation=clearcaches batch=5 max_unavailable=5 swap=True
+
+    :param tgt: target of the proxies
+    :param operation: restart, clearcaches or install. Default is restart, which waits until the proxy is ready
+    :param tgt_type: type of the target. Default is glob
+    :param batch: number or percentage of the proxies in a wave. Default is 10%
+    :param max_unavailable: maximum number or percentage of proxies that may be unavailable at the same time.
+                            Default is the size of a wave
+    :param max_failure_rate: the rollout stops when more than this fraction of the proxies failed. Default is 0.1
+    :param health_timeout: maximum number of seconds a wave may take to get healthy. Default is 300
+    :param timeout: maximum number of seconds the operation may take on a proxy. Default is 3600
+    :param test: When True, only show the waves
+    :param kwargs: passed to the execution module, e.g. swap=True for clearcaches or deadline=120 for restart
+    :return: dict with per proxy the wave, the duration of the operation, the time until healthy and the outcome
+    """
+    start_time = time.monotonic()
+    if operation not in ROLLOUT_OPERATIONS:
+        return {'success': False, 'message': f"Unknown operation {operation}, use one of "
+                                             f"{', '.join(ROLLOUT_OPERATIONS)}"}
+    operation_kwargs = dict(ROLLOUT_OPERATIONS[operation])
+    operation_kwargs.update({key: value for key, value in kwargs.items() if not key.startswith("__")})
+
+    ping = __salt__['salt.execute'](tgt, 'test.ping', tgt_type=tgt_type, timeout=MINION_TIMEOUT)
+    minions = sorted(minion for minion, result in ping.items() if result is True)
+    if not minions:
+        return {'success': False, 'message': f"No minions matched or answered for target {tgt}"}
+    size = _wave_size(batch, len(minions))
+    budget = size if max_unavailable is None else _wave_size(max_unavailable, len(minions))
+    # proxies that are already down use up the budget of unavailable proxies
+    unavailable = set() if operation == "install" else set(minions) - _healthy(minions)
+    if test:
+        wave_size = max(0, min(size, budget - len(unavailable)))
+        return {'success': wave_size > 0, 'message': f"{operation} would be executed on {len(minions)} proxies",
+                'waves': [minions[index:index + wave_size] for index in range(0, len(minions), wave_size)]
+                if wave_size else [], 'unavailable': sorted(unavailable)}
+
+    proxies = {}
+    remaining = list(minions)
+    failed = 0
+    number = 0
+    message = None
+    while remaining:
+        room = budget - len(unavailable)
+        if room <= 0:
+            message = f"Rollout stopped: {len(unavailable)} proxies unavailable, max_unavailable is {budget}"
+            break
+        number += 1
+        wave, remaining = remaining[:min(size, room)], remaining[min(size, room):]
+        _progress(f"{operation}/wave", {'wave': number, 'minions': wave,
+                                        'message': f"wave {number}: {operation} on {', '.join(wave)}"})
+        results = _run_wave(wave, operation, operation_kwargs, int(timeout), number)
+        health = _wait_healthy([minion for minion in wave if results[minion]['success']], float(health_timeout))
+        for minion in wave:
+            result = dict(results[minion], wave=number, time_to_healthy=health.get(minion))
+            if result['success'] and result['time_to_healthy'] is None:
+                result['success'] = False
+                result['message'] = f"Not healthy within {health_timeout}s after {operation}"
+            proxies[minion] = result
+            if result['success']:
+                unavailable.discard(minion)
+            else:
+                failed += 1
+                unavailable.add(minion)
+        done = len(proxies)
+        if failed / done > float(max_failure_rate):
+            message = (f"Rollout stopped after wave {number}: {failed} of {done} proxies failed, "
+                       f"max_failure_rate is {max_failure_rate}")
+            break
+
+    ret = {'success': not failed and not remaining,
+           'message': message or f"{operation} executed on {len(proxies)} proxies, {failed} failed",
+           'waves': number, 'proxies': proxies, 'duration': round(time.monotonic() - start_time, 3)}
+    if remaining:
+        ret['skipped'] = remaining
+        log.error(ret['message'])
+    _progress(f"{operation}/done", {key: value for key, value in ret.items() if key != 'proxies'})
+    return ret
@@ -6,15 +6,29 @@
 # 2. Sync the modules to your minions: `salt '*' saltutil.sync_states`
 #    or `salt '*' saltutil.sync_all`
 # 3. Now you can use it in your SLS files.
-import base64
+import functools
 import os
 import logging
-import socket
-import xmlrpc.client
+import re
+import time
 
 # It's good practice to set up a logger for your module
 log = logging.getLogger(__name__)
 
+# constants of the SMLM API, the configuration, the offline bundle and the execution of commands are in
+# _utils/smlm_proxy_core.py
+# status results are kept in __context__ for this amount of seconds
+STATUS_CACHE_KEY = "smlmproxy.status_cache"
+STATUS_CACHE_TTL = 15
+# deployed configuration of the proxy and the containers using the files. config.yaml is used by all containers,
+# except for the keys listed in PROXY_CONFIG_KEY_CONTAINERS
+PROXY_CONFIG_DIR = "/etc/uyuni/proxy"
+PROXY_CONTAINERS = ["uyuni-proxy-httpd", "uyuni-proxy-salt-broker", "uyuni-proxy-squid", "uyuni-proxy-ssh",
+                    "uyuni-proxy-tftpd"]
+PROXY_CONFIG_CONTAINERS = {'httpd.yaml': ["uyuni-proxy-httpd"], 'ssh.yaml': ["uyuni-proxy-ssh"]}
+PROXY_CONFIG_KEY_CONTAINERS = {'max_cache_size_mb': ["uyuni-proxy-squid"]}
+PROXY_POD_UNIT = "/etc/systemd/system/uyuni-proxy-pod.service"
+
 __virtualname__ = 'smlmproxy' # This is how you'll call the state in SLS files (e.g., mystate.my_action_one)
 
 def __virtual__():
@@ -28,40 +42,119 @@ def __virtual__():
     # Example: return False, "The mymodule execution module not found" if not __salt__['mymodule.check_dependency']()
     return __virtualname__
 
+def _core():
+    """
+    Get the implementation shared with the smlm_proxy execution module, bound to the dunders of this module.
+    :return: ProxyCore
+    """
+    return __utils__['smlm_proxy_core.core'](__salt__, __opts__, __context__)
+
 def _proxy_software_installed():
     """
     Check if the proxy software is installed.
     :return:
     """
-    if os.path.isfile("/usr/bin/mgrpxy"):
-        return True
-    return False
+    return _core().software_installed()
 
-def _execute_command(cmd):
+def _execute_command(cmd, **kwargs):
+    """
+    Execute the given command without a shell, see ProxyCore.execute_command().
+    :return: dict with success, message (stdout), error (stderr), retcode, duration and truncated
     """
-    Execute the given command
+    return _core().execute_command(cmd, **kwargs)
 
-    :param cmd:
+def _login_smlm(config=None):
+    """
+    Login to SMLM. The session is kept in __context__, use _logout_smlm() to end it.
+    :return: error, client connections and session key
+    """
+    return _core().login_smlm(config)
+
+def _logout_smlm():
+    """
+    Logout from SMLM when a session is present and close the connection.
     :return:
     """
-    ret = {}
-    cmd_result = __salt__['cmd.run_all'](cmd, python_shell=True)
-    if cmd_result['retcode'] != 0:
-        ret.update({'success': False, 'message': cmd_result['stdout'], 'error': cmd_result['stderr']})
-        log.error(ret['message'])
-    else:
-        ret['success'] = True
-        ret['message'] = cmd_result['stdout']
+    _core().logout_smlm()
+
+def _mgrpxy_install(bundle, timer=None):
+    """
+    Install the proxy containers with mgrpxy, using the configuration in /etc/uyuni/config.tar.gz.
+
+    :param bundle: verified offline installation bundle, or None
+    :param timer: PhaseTimer recording the loading of the images and mgrpxy install
+    :return:
+    """
+    result = _core().mgrpxy_install(bundle, timer)
+    _invalidate_status_cache()
+    return result
+
+def _status_cache():
+    """
+    Get the status cache of this run from __context__.
+
+    :return: dict with the cached status result, the time it was collected and the probe counters
+    """
+    if STATUS_CACHE_KEY not in __context__:
+        __context__[STATUS_CACHE_KEY] = {'result': None, 'timestamp': 0, 'cached': 0, 'executed': 0}
+    return __context__[STATUS_CACHE_KEY]
+
+def _invalidate_status_cache():
+    """
+    Forget the cached status. Must be called after every action that changes the state of the proxy.
+    :return:
+    """
+    _status_cache()['result'] = None
+
+def _report_status_probes(func):
+    """
+    Decorator adding the number of status probes served from the cache and the number executed in this run to the
+    state result as status_probes.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        ret = func(*args, **kwargs)
+        cache = _status_cache()
+        ret['status_probes'] = {'cached': cache['cached'], 'executed': cache['executed']}
+        return ret
+    return wrapper
+
+def _status_proxy(verbose=False):
+    """
+    Check if the proxy is running. The compact status is cached in __context__ for STATUS_CACHE_TTL seconds,
+    so the states of one run don't probe the proxy again and again.
+
+    :param verbose: When True, 'mgrpxy status' is used instead of the compact status per container.
+    :return:
+    """
+    cache = _status_cache()
+    if not verbose and cache['result'] is not None and time.monotonic() - cache['timestamp'] < STATUS_CACHE_TTL:
+        cache['cached'] += 1
+        log.debug(f"Status served from cache (cached: {cache['cached']}, executed: {cache['executed']})")
+        return dict(cache['result'])
+    cache['executed'] += 1
+    log.debug(f"Status probe executed (cached: {cache['cached']}, executed: {cache['executed']})")
+    ret = _probe_status_proxy(verbose)
+    if not verbose:
+        cache['result'] = dict(ret)
+        cache['timestamp'] = time.monotonic()
     return ret
 
-def _status_proxy():
+def _probe_status_proxy(verbose=False):
     """
-    Check if the proxy is running.
+    Determine the status of the proxy without using the cache.
+
+    :param verbose: When True, 'mgrpxy status' is used instead of the compact status per container.
     :return:
     """
     if _proxy_software_installed():
-        cmd = 'mgrpxy status'
-        return _execute_command(cmd)
+        if verbose:
+            cmd = ["mgrpxy", "status"]
+            return _execute_command(cmd)
+        containers = _core().containers_status()
+        if containers and all(container['active'] == 'active' for container in containers.values()):
+            return {'success': True, 'message': "SMLM Proxy running", 'containers': containers}
+        return {'success': False, 'message': "SMLM Proxy not running", 'containers': containers}
     else:
         ret = {'success': False, 'message': "SMLM Proxy software in not installed"}
         log.error(ret['message'])
@@ -76,142 +169,218 @@ def _check_if_active():
     ret = _status_proxy()
     if ret['success']:
         return {'success': True, 'message': "Proxy already running"}
-    if os.path.isfile("/etc/uyuni/proxy/config.yaml") or os.path.isfile("/etc/uyuni/proxy/httpd.yaml") or os.path.isfile("/etc/uyuni/proxy/ssh.yaml"):
+    if _core().config_deployed():
         return {'success': True, 'message': "Proxy already configured"}
     return {'success': False, 'message': "Proxy not configured"}
 
-def _check_parameters():
+def _yaml_sections(data):
     """
-    Check if the certificate date is available and if this is the case,
-    create the config file for the proxy.
-    :return:
+    Get the top level keys of a yaml file, so changed keys can be found. When the file can't be parsed, it is
+    split in the lines per top level key, without trailing whitespace and empty lines.
+
+    :param data: content of the file
+    :return: dict with per key the value or the lines of the key
     """
-    root_crt, err = _get_pillar_data("proxy:root_crt")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    server_crt, err = _get_pillar_data("proxy:server_crt")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    server_key, err = _get_pillar_data("proxy:server_key")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    smlm_cred, err = _get_pillar_data("proxy:smlmcred")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    email, err = _get_pillar_data("proxy:email")
-    if err:
-        log.error(err)
-        return {'error': err, 'success': False}
-    return {'success': True}
+    import yaml
+    try:
+        parsed = yaml.safe_load(data)
+    except yaml.YAMLError:
+        parsed = None
+    if isinstance(parsed, dict):
+        return parsed
+    sections = {}
+    key = None
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        match = re.match(r"^([A-Za-z_][\w-]*):", line)
+        if match:
+            key = match.group(1)
+        if line.strip():
+            sections.setdefault(key, []).append(line.rstrip())
+    return sections
+
+def _affected_containers(name, old, new):
+    """
+    Get the containers using a changed configuration file. A change of the formatting only, e.g. whitespace,
+    doesn't affect any container.
 
-def _login_smlm():
+    :param name: name of the file in /etc/uyuni/proxy
+    :param old: deployed content, or None
+    :param new: desired content
+    :return: list of containers
     """
-    Login to SMLM
-    :return: error, client connections and session key
+    if old is None:
+        return PROXY_CONFIG_CONTAINERS.get(name, PROXY_CONTAINERS)
+    old_sections = _yaml_sections(old)
+    new_sections = _yaml_sections(new)
+    if old_sections == new_sections:
+        return []
+    if name in PROXY_CONFIG_CONTAINERS:
+        return PROXY_CONFIG_CONTAINERS[name]
+    if name != "config.yaml":
+        return PROXY_CONTAINERS
+    containers = set()
+    for key in set(old_sections) | set(new_sections):
+        if old_sections.get(key) != new_sections.get(key):
+            if key not in PROXY_CONFIG_KEY_CONTAINERS:
+                return PROXY_CONTAINERS
+            containers.update(PROXY_CONFIG_KEY_CONTAINERS[key])
+    return sorted(containers)
+
+def _pod_ssh_port():
+    """
+    Get the port published for the ssh container by the deployed pod.
+
+    :return: port, or None when unknown
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.connect_ex((__salt__['grains.get']('master'), 443))
-    except Exception:
-        error = f"Unable to login to SUSE Manager server {__salt__['grains.get']('master')}."
-        return error, None, None
-    client = xmlrpc.client.Server("https://" + __salt__['grains.get']('master') + "/rpc/api")
-    smlm_cred, err = _get_pillar_data("proxy:smlmcred")
-    credentials = base64.b64decode(smlm_cred).decode('utf-8')
-    try:
-        session = client.auth.login(credentials.split(':')[0], credentials.split(':', 1)[1])
-    except Exception:
-        error = f"Unable to login to SUSE Manager server {__salt__['grains.get']('master')}."
-        return error, None, None
-    return None, client, session
-
-def _get_config():
-    # login to SMLM
-    err, client, session = _login_smlm()
-    if err:
-        return {'error': err, 'success': False}
-
-    # collecting all needed parameters
-    root_crt, _ = _get_pillar_data("proxy:root_crt")
-    server_crt, _ = _get_pillar_data("proxy:server_crt")
-    server_key, _ = _get_pillar_data("proxy:server_key")
-    email, _ = _get_pillar_data("proxy:email")
-    proxy_port, _ = _get_pillar_data("proxy:proxyport", error=False, default_value=8022)
-    max_cache, err = _get_pillar_data("proxy:maxcache", error=False, default_value=2048)
-    intermediate_crt, err = _get_pillar_data("proxy:intermediate_crt", error=False, default_value=[])
-    proxy_name = __salt__['grains.get']('fqdn')
-    smlm = __salt__['grains.get']('master')
-
-    intermediate = []
-    for x in intermediate_crt:
-        intermediate.append(x)
-
-    # ask smlm to create the config file
-    try:
-        config_file = client.proxy.container_config(session, proxy_name, proxy_port, smlm, max_cache, email, root_crt, intermediate, server_crt, server_key)
-    except Exception:
-        return {'error': "Unable to get config file", 'success': False}
-    # write config file to /etc/uyuni/proxy
-    file_config="/etc/uyuni/config.tar.gz"
     try:
-        # Ensure the directory exists before writing the file
-        #os.makedirs(os.path.dirname(file_config), exist_ok=True)
-        with open(file_config, 'wb') as f:
-            f.write(config_file.data)
-    except Exception as file_write_error:
-        return {'error': f"Error when writing the file\n{str(file_write_error)}\n{file_config}", 'success': False}
-    return {'success': True}
+        with open(PROXY_POD_UNIT, 'r') as f:
+            match = re.search(r"-p\s+(\d+):22\b", f.read())
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
 
-def _proxy_software_install(internet_access, os_finger):
+def _reconfigure_plan(config, config_data):
     """
-    Install proxy software.
+    Compare the desired configuration with the files deployed in /etc/uyuni/proxy.
 
-    :param internet_access:
-    :return:
+    :param config: ProxyConfig of this proxy
+    :param config_data: content of the desired configuration file
+    :return: dict with the changed files, the containers to restart and if mgrpxy install must be executed again
     """
-    cpu_arch = __salt__['grains.get']('cpuarch')
+    import io
+    import tarfile
+    drift = {}
+    with tarfile.open(fileobj=io.BytesIO(config_data)) as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            new = tar.extractfile(member).read()
+            old = _core().read_proxy_file(name)
+            if old != new:
+                drift[name] = {'old': old, 'new': new}
+    containers = set()
+    for name, change in drift.items():
+        containers.update(_affected_containers(name, change['old'], change['new']))
+    port = _pod_ssh_port()
+    return {'drift': drift, 'containers': sorted(containers), 'port': port,
+            'reinstall': port is not None and port != config.proxy_port}
+
+def _plan_changes(plan, config):
+    """
+    Get the changes of a reconfiguration, as shown in the state result. Files containing a private key
+    are reported without their content.
 
-    if internet_access:
-        packages = f"podman uyuni-storage-setup-proxy mgrpxy* mgrctl*"
-    else:
-        packages = f"podman uyuni-storage-setup-proxy mgrpxy* mgrctl* suse-manager-5.0-{cpu_arch}-proxy-*"
-    if "sle micro" in os_finger.lower():
-        ret = _execute_command(f"transactional-update -i pkg in {packages}")
-        if ret['success']:
-            _execute_command("systemctl enable podman")
-            ret['message'] = "Software installed. Reboot server and re-issue the same command to install proxy"
+    :param plan: result of _reconfigure_plan
+    :param config: ProxyConfig of this proxy
+    :return: dict with the changes
+    """
+    import difflib
+    changes = {}
+    files = {}
+    for name, change in plan['drift'].items():
+        if b"PRIVATE KEY" in (change['old'] or b"") + change['new']:
+            files[name] = "changed, the file contains a private key so the diff is not shown"
+            continue
+        old = (change['old'] or b"").decode('utf-8', errors='replace').splitlines()
+        new = change['new'].decode('utf-8', errors='replace').splitlines()
+        files[name] = "\n".join(difflib.unified_diff(old, new, f"{PROXY_CONFIG_DIR}/{name}",
+                                                      f"{PROXY_CONFIG_DIR}/{name}", lineterm=""))
+    if files:
+        changes['files'] = files
+    if plan['reinstall']:
+        changes['ssh_port'] = {'old': plan['port'], 'new': config.proxy_port}
+        changes['reinstall'] = True
+    elif plan['containers']:
+        changes['restarted'] = plan['containers']
+    return changes
+
+def _reconfigure(ret, config, bundle, timer):
+    """
+    Apply the differences between the desired and the deployed configuration of a proxy that is already
+    installed. Only changed files are replaced and only the containers using them are restarted. When the
+    ssh port changed, the pod has to be created again, so mgrpxy install is executed.
+
+    :param ret: state result
+    :param config: ProxyConfig of this proxy
+    :param bundle: verified offline installation bundle, or None
+    :param timer: PhaseTimer recording the phases
+    :return: state result
+    """
+    err, config_data = _core().desired_config(config, timer)
+    _logout_smlm()
+    if err:
+        ret['result'] = False
+        ret['comment'] = err
+        return ret
+    plan = _reconfigure_plan(config, config_data)
+    if not plan['drift'] and not plan['reinstall']:
+        ret['result'] = True
+        ret['comment'] = "SMLM Proxy configuration is up to date"
         return ret
+
+    result = _core().get_config(config)
+    if not result["success"]:
+        ret['result'] = False
+        ret['comment'] = result["error"]
+        return ret
+    if plan['reinstall']:
+        result = _mgrpxy_install(bundle, timer)
     else:
-        ret=_execute_command(f"zypper -n in {packages}")
-        if ret['success']:
-            ret1 = _execute_command("systemctl enable --now podman")
-            return ret1
-        else:
-            return ret
+        with timer.phase("reconfigure") as phase:
+            for name, change in plan['drift'].items():
+                _core().write_proxy_file(name, change['new'])
+            phase['bytes'] = sum(len(change['new']) for change in plan['drift'].values())
+            # files that only changed their formatting are replaced without restarting a container
+            result = {'success': True}
+            if plan['containers']:
+                result = _execute_command(["systemctl", "restart"] + [f"{container}.service"
+                                                                      for container in plan['containers']])
+            phase['outcome'] = "success" if result["success"] else "failed"
+        _invalidate_status_cache()
+    if not result["success"]:
+        ret['result'] = False
+        ret['comment'] = result["error"]
+        return ret
+    ret['changes'] = _plan_changes(plan, config)
+    ret['result'] = True
+    ret['comment'] = "SMLM Proxy configuration updated"
+    return ret
 
-def _get_pillar_data(pillar_key, error=True, default_value=None):
+def _test_installed(ret):
     """
-    Get the value of the given pillar key. Return None if it isn't found or if it is empty.
+    Show what installed would change. The configuration is only compared when a configuration generated
+    with the current parameters is cached, as requesting a new one registers the proxy in SMLM.
 
-    :param pillar_key:
-    :return: value of the pillar key
+    :param ret: state result
+    :return: state result
     """
-    data = __salt__['pillar.get'](pillar_key)
-
-    if data is None or not data:
-        if error:
-            error = (f"Pillar keys {pillar_key} is empty or not present. Please fix pillar data for "
-                     f"server {__salt__['grains.get']('fqdn')}.")
-            return None, error
-        else:
-            if default_value:
-                return default_value, None
-    return data, None
+    ret['result'] = None # None indicates test mode success, no changes made
+    if not _check_if_active()['success']:
+        ret['comment'] = "SMLM Proxy would have been installed on this server."
+        return ret
+    parameters = _core().check_parameters()
+    if not parameters['success']:
+        ret['result'] = False
+        ret['comment'] = parameters['error']
+        return ret
+    config = parameters['config']
+    cached_file = _core().cached_config(_core().config_hash(config.container_config_parameters()))
+    if not cached_file:
+        ret['comment'] = ("No configuration is cached for the current parameters. A new configuration would be "
+                          "requested from SMLM and applied when it differs from the deployed configuration.")
+        return ret
+    with open(cached_file, 'rb') as f:
+        plan = _reconfigure_plan(config, f.read())
+    if not plan['drift'] and not plan['reinstall']:
+        ret['result'] = True
+        ret['comment'] = "SMLM Proxy configuration is up to date"
+        return ret
+    ret['changes'] = _plan_changes(plan, config)
+    ret['comment'] = "SMLM Proxy configuration would have been updated."
+    return ret
 
+@_report_status_probes
 def started(name, error_when_running=False):
     """
     Starting the SMLM proxy.
@@ -252,7 +421,8 @@ def started(name, error_when_running=False):
                 ret['comment'] = "No action needed, proxy is already running."
                 ret['result'] = True
         else:
-            start_proxy = _execute_command("mgrpxy start")
+            start_proxy = _execute_command(["mgrpxy", "start"])
+            _invalidate_status_cache()
             if start_proxy["success"]:
                 ret['changes'] =  {'old': "proxy not running", 'new': "proxy running"}
                 ret['result'] = True
@@ -265,6 +435,7 @@ def started(name, error_when_running=False):
         log.error(f"Error in smlm_proxy.started: {e}", exc_info=True)
     return ret
 
+@_report_status_probes
 def stopped(name):
     """
     Stopping the SMLM proxy.
@@ -295,7 +466,8 @@ def stopped(name):
     try:
         status_proxy = _status_proxy()['success']
         if status_proxy:
-            stop_proxy = _execute_command("mgrpxy stop")
+            stop_proxy = _execute_command(["mgrpxy", "stop"])
+            _invalidate_status_cache()
             if stop_proxy["success"]:
                 ret['changes'] =  {'old': "proxy running", 'new': "proxy not running"}
                 ret['result'] = True
@@ -311,16 +483,46 @@ def stopped(name):
         log.error(f"Error in smlm_proxy.started: {e}", exc_info=True)
     return ret
 
-def restart(name):
+def _restart(ret):
+    """
+    Stop and start the proxy, while the operation lock is held.
+
+    :param ret: state result, filled with the result
+    :return: state result
+    """
+    status_proxy = _status_proxy()['success']
+    if status_proxy:
+        stop_proxy = _execute_command(["mgrpxy", "stop"])
+        _invalidate_status_cache()
+        if not stop_proxy["success"]:
+            ret['comment'] = f"Proxy stop failed with error {stop_proxy}"
+            ret['result'] = False
+            return ret
+    start_proxy = _execute_command(["mgrpxy", "start"])
+    _invalidate_status_cache()
+    if start_proxy["success"]:
+        ret['changes'] =  {'old': "proxy running", 'new': "proxy restarted"}
+        ret['result'] = True
+    else:
+        ret['comment'] = f"Proxy started failed with error {start_proxy}"
+        ret['result'] = False
+    return ret
+
+@_report_status_probes
+def restart(name, wait_ready=False, deadline=300):
     """
     Restarting the SMLM proxy.
 
     :param name: The unique ID for this state.
+    :param wait_ready: When True, the state waits until https, the salt broker and squid are ready, and returns
+                       the time to stop, the time until ready and the downtime
+    :param deadline: maximum number of seconds to wait until the proxy is ready
 
     Example state file:
     proxy-restart:
       smlmproxy.restart:
         - name: proxy
+        - wait_ready: True
     """
     ret = {
         'name': name,
@@ -339,39 +541,46 @@ def restart(name):
 
     # --- Actual Action Logic ---
     try:
-        status_proxy = _status_proxy()['success']
-        if status_proxy:
-            stop_proxy = _execute_command("mgrpxy stop")
-            if not stop_proxy["success"]:
-                ret['comment'] = f"Proxy stop failed with error {stop_proxy}"
+        if wait_ready:
+            result = __salt__['smlm_proxy.restart'](wait=True, deadline=deadline)
+            _invalidate_status_cache()
+            timings = {key: result[key] for key in ('time_to_stop', 'time_to_ready', 'downtime') if key in result}
+            ret['result'] = result['success']
+            ret['comment'] = result['message'] if result['success'] else result.get('error') or result['message']
+            if result['success']:
+                ret['changes'] = dict({'old': "proxy running", 'new': "proxy restarted and ready"}, **timings)
+            return ret
+        # the same lock as smlm_proxy.restart, so the restart doesn't run during e.g. clearcaches swap=True
+        with _core().operation_lock("restart") as err:
+            if err:
+                ret['comment'] = err
                 ret['result'] = False
                 return ret
-        start_proxy = _execute_command("mgrpxy start")
-        if start_proxy["success"]:
-            ret['changes'] =  {'old': "proxy running", 'new': "proxy restarted"}
-            ret['result'] = True
-        else:
-            ret['comment'] = f"Proxy started failed with error {start_proxy}"
-            ret['result'] = False
+            return _restart(ret)
     except Exception as e:
         ret['comment'] = f"Error in started: {str(e)}"
         ret['result'] = False
         log.error(f"Error in smlm_proxy.started: {e}", exc_info=True)
     return ret
 
-def installed(name, internet_access=False, install_when_missing=True, cert_self_signed=False):
+def images_present(name, tag=None, registry=None, digests=None, workers=3):
     """
-    configure the SMLM proxy.
+    Make sure the container images of the SMLM proxy are present, so an installation or upgrade
+    doesn't have to pull them. Images that are present are not pulled again.
 
-    example: salt '<fqdn>' smlm_proxy.install
+    :param name: The unique ID for this state.
+    :param tag: tag of the images. Default is the pillar value proxy:tag or the default of the installed mgrpxy
+    :param registry: registry and path of the images, without the cpu architecture. Default is the pillar value
+                     proxy:registry or the default of the installed mgrpxy
+    :param digests: dict with the expected digest (sha256:...) per image name, e.g. proxy-httpd
+    :param workers: number of images pulled at the same time
 
-    :param name: Default is proxy.
-    :param internet_access: When True, when server has internet access. The image from register.suse.com will be used.
-    :param install_when_missing: When True, software will be installed when missing
-    :param cert_self_signed: When True, self-signed certificate will be used. Currently not implemented!!!!
-    :return:
+    Example state file:
+    proxy-images:
+      smlmproxy.images_present:
+        - name: proxy
+        - tag: 5.1.0
     """
-
     ret = {
         'name': name,
         'changes': {},
@@ -379,16 +588,45 @@ def installed(name, internet_access=False, install_when_missing=True, cert_self_
         'comment': ''
     }
 
-    log.debug(f"Executing smlmproxy.installed for {name}")
-    log.debug(f"Parameters received: internet_access='{internet_access}', install_when_missing='{install_when_missing}'"
-              f"cert_self_signed='{cert_self_signed}', ")
+    log.debug(f"Executing smlmproxy.images_present for {name}")
 
-    # --- Test Mode (dry-run) ---
-    if __opts__['test']:
-        ret['result'] = None # None indicates test mode success, no changes made
-        ret['comment'] = f"SMLM Proxy would have been installed on this server."
-        return ret
+    try:
+        result = __salt__['smlm_proxy.pull_images'](tag=tag, registry=registry, digests=digests, workers=workers,
+                                                     test=__opts__['test'])
+        # images pulled before another image failed are reported as changes as well
+        pulled = {image: values['digest'] for image, values in result.get('images', {}).items()
+                  if values.get('pulled')}
+        if pulled:
+            ret['changes'] = {'pulled': pulled}
+        if not result['success']:
+            ret['comment'] = result['message']
+            return ret
+        if __opts__['test']:
+            ret['result'] = None if result['missing'] else True
+            ret['comment'] = (f"Images {', '.join(result['missing'])} would have been pulled." if result['missing']
+                              else "All images are present.")
+            return ret
+        ret['result'] = True
+        ret['comment'] = result['message']
+    except Exception as e:
+        ret['comment'] = f"Error in images_present: {str(e)}"
+        ret['result'] = False
+        log.error(f"Error in smlm_proxy.images_present: {e}", exc_info=True)
+    return ret
 
+def _installed(ret, internet_access, install_when_missing, cert_self_signed):
+    """
+    Execute the phases of installed(), while the operation lock is held.
+
+    :param ret: state return, filled with the result
+    :param internet_access: When True, when server has internet access
+    :param install_when_missing: When True, software will be installed when missing
+    :param cert_self_signed: When True, self-signed certificate will be used
+    :return:
+    """
+    # the duration, bytes and outcome per phase. The dict is filled while the phases are executed
+    timer = _core().phase_timer("installed")
+    ret['timings'] = timer.timings
     try:
         # self-signed certificates is currently not supported. Will be added later
         if cert_self_signed:
@@ -397,26 +635,44 @@ def installed(name, internet_access=False, install_when_missing=True, cert_self_
                               "Please follow the official documentation")
             return ret
 
-        # check if proxy is already running
-        result = _check_if_active()
-        if result['success']:
-            ret['result'] = False
-            ret['comment'] = "Proxy already running"
-            return ret
+        # check if the proxy is already deployed, the pillar data, the software and if SMLM can be reached
+        with timer.phase("preflight") as phase:
+            preflight = _core().preflight(_check_if_active, _proxy_software_installed, running_is_error=False)
+            log.debug(f"Preflight timings: {preflight['timings']}")
+            if not preflight['success']:
+                phase['outcome'] = "failed"
+                ret['result'] = False
+                ret['comment'] = "\n".join(preflight['errors'])
+                return ret
+        config = preflight['config']
+
+        # verify the offline installation bundle, when present
+        bundle = None
+        if config.bundle:
+            with timer.phase("bundle_verify") as phase:
+                err, bundle = _core().verify_bundle(config.bundle)
+                if err:
+                    phase['outcome'] = "failed"
+                    ret['result'] = False
+                    ret['comment'] = err
+                    return ret
+                phase['bytes'] = _core().file_sizes(bundle['rpms'] + [path for path, _ in bundle['images']])
 
-        # configure the proxy
-        result = _check_parameters()
-        if not result["success"]:
-            ret['result'] = False
-            ret['comment'] = result["error"]
-            return ret
+        # an installed proxy is only reconfigured when its configuration differs
+        if preflight['deployed']:
+            return _reconfigure(ret, config, bundle, timer)
 
         # check if podman and mgrpxy are installed
         # when install_when_missing is True install the software when missing. Otherwise, write an error.
-        os_finger = __salt__['grains.get']('osfinger')
-        if not _proxy_software_installed():
+        os_finger = preflight['os_finger']
+        if not preflight['software_installed']:
             if install_when_missing:
-                result = _proxy_software_install(internet_access, os_finger)
+                with timer.phase("software_install") as phase:
+                    result = _core().software_install(internet_access, os_finger, bundle['rpms'] if bundle else None)
+                    phase['outcome'] = "success" if result["success"] else "failed"
+                    if bundle:
+                        phase['bytes'] = _core().file_sizes(bundle['rpms'])
+                _invalidate_status_cache()
                 if result["success"]:
                     if "sle micro" in os_finger.lower():
                         ret['result'] = True
@@ -433,22 +689,24 @@ def installed(name, internet_access=False, install_when_missing=True, cert_self_
                 return ret
 
         # configure extra disk
-        result = _get_config()
+        result = _core().get_config(config, timer)
+        _logout_smlm()
         if not result["success"]:
             ret['result'] = False
             ret['comment'] = result["error"]
             return ret
         # configure extra disk
 
-        extra_disk, _ = _get_pillar_data("proxy:extradisk", error=False, default_value="")
-        result = _execute_command(f"mgr-storage-proxy {extra_disk}")
+        with timer.phase("storage") as phase:
+            result = _execute_command(["mgr-storage-proxy"] + ([config.extra_disk] if config.extra_disk else []))
+            phase['outcome'] = "success" if result["success"] else "failed"
         if not result["success"]:
             ret['result'] = False
             ret['comment'] = result["error"]
             return ret
 
-        # start the proxy
-        result = _execute_command("mgrpxy install podman /etc/uyuni/config.tar.gz")
+        # load the container images of the bundle and start the proxy
+        result = _mgrpxy_install(bundle, timer)
         if not result["success"]:
             ret['result'] = False
             ret['comment'] = result["error"]
@@ -462,3 +720,40 @@ def installed(name, internet_access=False, install_when_missing=True, cert_self_
     ret['changes'] =  {'old': "proxy not installed", 'new': "proxy installed, configured and running"}
     ret['result'] = True
     return ret
+
+@_report_status_probes
+def installed(name, internet_access=False, install_when_missing=True, cert_self_signed=False):
+    """
+    configure the SMLM proxy.
+
+    example: salt '<fqdn>' smlm_proxy.install
+
+    :param name: Default is proxy.
+    :param internet_access: When True, when server has internet access. The image from register.suse.com will be used.
+    :param install_when_missing: When True, software will be installed when missing
+    :param cert_self_signed: When True, self-signed certificate will be used. Currently not implemented!!!!
+    :return:
+    """
+
+    ret = {
+        'name': name,
+        'changes': {},
+        'result': False, # Default to False, set to True on success
+        'comment': ''
+    }
+
+    log.debug(f"Executing smlmproxy.installed for {name}")
+    log.debug(f"Parameters received: internet_access='{internet_access}', install_when_missing='{install_when_missing}'"
+              f"cert_self_signed='{cert_self_signed}', ")
+
+    # --- Test Mode (dry-run) ---
+    if __opts__['test']:
+        return _test_installed(ret)
+
+    # only one operation changing the proxy runs at a time, e.g. not smlm_proxy.clearcaches during the installation
+    with _core().operation_lock("install") as err:
+        if err:
+            ret['result'] = False
+            ret['comment'] = err
+            return ret
+        return _installed(ret, internet_access, install_when_missing, cert_self_signed)
@@ -0,0 +1,1329 @@
+# smlm_proxy_core.py
+# This is a custom Salt utils module, shared by the smlm_proxy execution module and the smlmproxy state module.
+#
+# To use this module:
+# 1. Place this file in your Salt master's `_utils` directory (e.g., /srv/salt/_utils/).
+# 2. Sync the modules to your minions: `salt '*' saltutil.sync_all`
+#
+# The Salt utils loader does not provide __salt__, so the modules pass their dunders to core(), which returns
+# a ProxyCore. Modules that are only needed by some functions (xmlrpc.client, ssl, socket, tarfile,
+# concurrent.futures, ...) are imported by these functions, so loading the modules stays cheap, e.g. for status.
+import contextlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+log = logging.getLogger(__name__)
+
+# timeouts in seconds for the SMLM API. Generating the proxy configuration can take a while
+SMLM_CONNECT_TIMEOUT = 10
+SMLM_READ_TIMEOUT = 120
+SMLM_API_PORT = 443
+SMLM_SESSION_KEY = "smlm_proxy_core.smlm_session"
+SMLM_SESSION_TTL = 600
+PROBE_TIMEOUT = 3
+# the duration, bytes and outcome of every phase of an installation are sent as event with this tag
+PHASE_EVENT_TAG = "smlm_proxy/phase"
+# operations executed with detach=True are recorded as job below the minion cachedir. Their progress is sent as
+# event with tag smlm_proxy/job/<job>/progress, at most every JOB_PROGRESS_INTERVAL seconds per phase
+JOBS_DIR = "smlm_proxy/jobs"
+JOBS_KEPT = 50
+JOB_START_TIMEOUT = 120
+JOB_EVENT_TAG = "smlm_proxy/job"
+JOB_PROGRESS_INTERVAL = 2
+JOB_CONTEXT_KEY = "smlm_proxy_core.job"
+# only one operation changing the proxy runs at a time. A job waits this amount of seconds for the lock
+OPERATION_LOCK_FILE = "smlm_proxy/operation.lock"
+OPERATION_LOCK_WAIT = 30
+# phases of the operations in their order, used to estimate the percentage of a job
+OPERATION_PHASES = {'install': ["preflight", "bundle_verify", "software_install", "config_staged", "login",
+                                "config_fetch", "storage", "images_load", "mgrpxy_install"]}
+# generated proxy configurations are cached in this directory below the minion cachedir
+CONFIG_CACHE_DIR = "smlm_proxy/config"
+# configurations generated on the master by the smlm_proxy runner are delivered with the pillar of the proxy,
+# by a file_tree ext_pillar, as base64 encoded value of smlm_proxy_staged:<hash>
+STAGED_CONFIG_PILLAR = "smlm_proxy_staged"
+# configuration generated by SMLM and the directory where mgrpxy deploys it
+PROXY_CONFIG_FILE = "/etc/uyuni/config.tar.gz"
+PROXY_CONFIG_DIR = "/etc/uyuni/proxy"
+PROXY_CONFIG_FILES = ("config.yaml", "httpd.yaml", "ssh.yaml")
+# offline installation bundle: RPMs and container image tarballs, listed with their checksum in SHA256SUMS
+BUNDLE_MANIFEST = "SHA256SUMS"
+BUNDLE_IMAGE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.xz", ".tar.zst")
+BUNDLE_LOADED_FILE = "smlm_proxy/bundle_images.json"
+# commands are killed after this amount of seconds. Only the first and last part of their output is kept
+COMMAND_TIMEOUT = 3600
+COMMAND_OUTPUT_LIMIT = 65536
+# container images of the proxy and the mgrpxy option for each image. The images are <registry>/<cpu arch>/<image>,
+# the registry and the tag are the pillar values proxy:registry and proxy:tag, or the defaults of the installed mgrpxy
+PROXY_IMAGES = {'proxy-httpd': "httpd", 'proxy-salt-broker': "saltbroker", 'proxy-squid': "squid",
+                'proxy-ssh': "ssh", 'proxy-tftpd': "tftpd"}
+PROXY_UNIT_PATTERN = "uyuni-proxy-*"
+PROXY_UNIT_PROPERTIES = "Id,ActiveState,SubState,ActiveEnterTimestamp,NRestarts"
+
+def core(salt, opts, context):
+    """
+    Get the shared implementation for a module.
+
+    :param salt: __salt__ of the module
+    :param opts: __opts__ of the module
+    :param context: __context__ of the module
+    :return: ProxyCore
+    """
+    return ProxyCore(salt, opts, context)
+
+@dataclass(frozen=True)
+class ProxyConfig:
+    """
+    The proxy: pillar of this minion, loaded and validated once by ProxyCore.check_parameters().
+    """
+    root_crt: str
+    server_crt: str
+    server_key: str = field(repr=False)
+    smlm_cred: str = field(repr=False)
+    email: str
+    proxy_name: str
+    smlm: str
+    proxy_port: int = 8022
+    max_cache: int = 2048
+    extra_disk: str = ""
+    bundle: str = ""
+    intermediate_crt: tuple = ()
+
+    def container_config_parameters(self):
+        """
+        The parameters for proxy.container_config, without the session.
+        :return:
+        """
+        return [self.proxy_name, self.proxy_port, self.smlm, self.max_cache, self.email, self.root_crt,
+                list(self.intermediate_crt), self.server_crt, self.server_key]
+
+class JobProgress:
+    """
+    Progress of a running job. Every update is written to the job record, which is read by job_status, and sent
+    to the master as event. Updates within the same phase are throttled, they can come from several threads.
+    """
+    def __init__(self, salt, path, job):
+        import threading
+        self.salt = salt
+        self.path = path
+        self.job = job
+        self.lock = threading.Lock()
+        self.last_update = 0
+
+    def update(self, phase, percent=None, bytes_done=0, force=False):
+        """
+        Report the progress of the job.
+
+        :param phase: phase the job is in
+        :param percent: estimated percentage of the job that is done, None when unknown
+        :param bytes_done: bytes processed by the job so far
+        :param force: When True, the update is not throttled, e.g. at the start and the end of a phase
+        :return:
+        """
+        with self.lock:
+            progress = self.job.get('progress') or {}
+            now = time.monotonic()
+            if not force and progress.get('phase') == phase and now - self.last_update < JOB_PROGRESS_INTERVAL:
+                return
+            self.last_update = now
+            self.job['progress'] = {'phase': phase, 'percent': percent, 'bytes': bytes_done,
+                                    'updated': round(time.time(), 3)}
+            write_job(self.path, self.job)
+            try:
+                self.salt['event.send'](f"{JOB_EVENT_TAG}/{self.job['job']}/progress",
+                                        dict(self.job['progress'], job=self.job['job'],
+                                             operation=self.job['operation']))
+            except Exception as e:
+                log.debug(f"Unable to send the progress of job {self.job['job']}: {e}")
+
+class PhaseTimer:
+    """
+    Record the duration, bytes transferred and outcome of the phases of an operation. Every finished phase is
+    sent to the master as event with tag smlm_proxy/phase/<phase>. When the operation runs as job, the start and
+    the end of every phase are reported to its JobProgress as well.
+    """
+    def __init__(self, salt, operation=None, progress=None):
+        self.salt = salt
+        self.operation = operation
+        self.timings = {}
+        self.progress = progress
+        self.phases = OPERATION_PHASES.get(operation, [])
+        self.bytes = 0
+
+    def _report(self, name, finished):
+        """
+        Report the start or the end of a phase to the JobProgress. The percentage is the share of the phases of the
+        operation that are done.
+        """
+        if self.progress is None:
+            return
+        percent = None
+        if name in self.phases:
+            percent = round(100 * (self.phases.index(name) + finished) / len(self.phases))
+        self.progress.update(name, percent, self.bytes, force=True)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase. The yielded dict can be used to set the bytes and the outcome of the phase.
+
+        :param name: name of the phase
+        """
+        record = {'outcome': "success", 'bytes': 0}
+        start_time = time.monotonic()
+        self._report(name, False)
+        try:
+            yield record
+        except Exception:
+            record['outcome'] = "error"
+            raise
+        finally:
+            record['duration'] = round(time.monotonic() - start_time, 3)
+            self.timings[name] = record
+            self.bytes += record['bytes']
+            self._report(name, True)
+            if self.operation:
+                try:
+                    self.salt['event.send'](f"{PHASE_EVENT_TAG}/{name}",
+                                            dict(record, operation=self.operation, phase=name))
+                except Exception as e:
+                    log.debug(f"Unable to send the timing of phase {name}: {e}")
+
+class BoundedOutput:
+    """
+    Output of a command, limited to the first and the last limit / 2 bytes. The bytes in between are counted,
+    but not kept, so memory use doesn't depend on the amount of output.
+    """
+    def __init__(self, limit):
+        import collections
+        self.head_limit = limit // 2
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.tail_limit = limit - self.head_limit
+        self.total = 0
+
+    def add(self, chunk):
+        self.total += len(chunk)
+        if len(self.head) < self.head_limit:
+            room = self.head_limit - len(self.head)
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail.append(chunk)
+            self.tail_size += len(chunk)
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                self.tail_size -= len(self.tail.popleft())
+
+    @property
+    def truncated(self):
+        return self.total > len(self.head) + self.tail_size
+
+    def text(self):
+        tail = b"".join(self.tail)
+        if self.truncated:
+            tail = tail[-self.tail_limit:]
+            skipped = self.total - len(self.head) - len(tail)
+            data = bytes(self.head) + f"\n... {skipped} bytes of output skipped ...\n".encode() + tail
+        else:
+            data = bytes(self.head) + tail
+        return data.decode('utf-8', errors='replace').strip()
+
+def _read_stream(stream, output):
+    """
+    Read a stream of a command until it is closed.
+    """
+    for chunk in iter(lambda: stream.read(65536), b""):
+        output.add(chunk)
+    stream.close()
+
+_transport_class = None
+
+def _timeout_safe_transport():
+    """
+    Get a HTTPS transport for the SMLM API with a connect and a read timeout. The connection is kept open
+    between calls (HTTP keep-alive), so only the first call pays for the TCP and TLS handshake. The class
+    is created on first use, so xmlrpc.client is only imported when SMLM is contacted.
+    """
+    global _transport_class
+    if _transport_class is None:
+        import xmlrpc.client
+
+        class _TimeoutSafeTransport(xmlrpc.client.SafeTransport):
+            def __init__(self, connect_timeout=SMLM_CONNECT_TIMEOUT, read_timeout=SMLM_READ_TIMEOUT, **kwargs):
+                super().__init__(**kwargs)
+                self.connect_timeout = connect_timeout
+                self.read_timeout = read_timeout
+
+            def make_connection(self, host):
+                connection = super().make_connection(host)
+                if connection.sock is None:
+                    connection.timeout = self.connect_timeout
+                    connection.connect()
+                    connection.sock.settimeout(self.read_timeout)
+                return connection
+
+        _transport_class = _TimeoutSafeTransport
+    return _transport_class()
+
+def smlm_client(smlm):
+    """
+    Get a client for the API of SMLM.
+
+    :param smlm: hostname of SMLM
+    :return: xmlrpc.client.ServerProxy
+    """
+    import xmlrpc.client
+    return xmlrpc.client.ServerProxy(f"https://{smlm}:{SMLM_API_PORT}/rpc/api", transport=_timeout_safe_transport())
+
+def smlm_login(client, smlm_cred):
+    """
+    Login to SMLM with the credentials of the proxy: pillar.
+
+    :param client: client of the SMLM API
+    :param smlm_cred: base64 encoded user:password
+    :return: session key
+    """
+    import base64
+    credentials = base64.b64decode(smlm_cred).decode('utf-8')
+    return client.auth.login(credentials.split(':')[0], credentials.split(':', 1)[1])
+
+def staged_config_path(minion_id, config_hash):
+    """
+    Get the path of a configuration staged by the smlm_proxy runner. The file_tree ext_pillar only gives the
+    files below hosts/<minion id> to that minion.
+
+    :param minion_id: id of the proxy minion
+    :param config_hash: hash of the parameters of the configuration
+    :return: path relative to the root_dir of the file_tree ext_pillar
+    """
+    return f"hosts/{minion_id}/{STAGED_CONFIG_PILLAR}/{config_hash}"
+
+def read_job(path):
+    """
+    Read a job record.
+
+    :param path: location of the record
+    :return: dict with the job, or None when the record is missing or invalid
+    """
+    try:
+        with open(path, 'r') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return job if isinstance(job, dict) else None
+
+def write_job(path, job):
+    """
+    Write a job record. The file is replaced atomically, so job_status never reads a partial record.
+
+    :param path: location of the record
+    :param job: dict with the job
+    :return:
+    """
+    try:
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(job, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log.warning(f"Unable to write job record {path}: {e}")
+
+def pid_alive(pid):
+    """
+    Check if a process is still running.
+    """
+    if not pid:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return True
+
+def percentiles(values):
+    """
+    Get the minimum, median, 90th percentile and maximum of the given values in milliseconds.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = lambda pct: values[min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1)]
+    return {'min': round(values[0] * 1000, 1), 'p50': round(rank(50) * 1000, 1),
+            'p90': round(rank(90) * 1000, 1), 'max': round(values[-1] * 1000, 1)}
+
+def probe_port(host, port, samples=1, timeout=PROBE_TIMEOUT, tls=False):
+    """
+    Connect to the given port a number of times and measure the connect time and, optionally, the TLS handshake.
+    After the first failing sample the port is not tried again, so an unreachable host fails fast.
+
+    :param host: host to connect to
+    :param port: TCP port
+    :param samples: number of connections
+    :param timeout: timeout in seconds for every connect and handshake
+    :param tls: When True, the TLS handshake is measured as well
+    :return: dict with reachable, the connect and TLS handshake times and the errors
+    """
+    import socket
+    import ssl
+    connect_times = []
+    tls_times = []
+    errors = []
+    context = ssl.create_default_context() if tls else None
+    for _ in range(samples):
+        start_time = time.monotonic()
+        try:
+            sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError as e:
+            errors.append(f"connect: {e}")
+            break
+        with sock:
+            connect_times.append(time.monotonic() - start_time)
+            if not tls:
+                continue
+            start_time = time.monotonic()
+            try:
+                with context.wrap_socket(sock, server_hostname=host):
+                    tls_times.append(time.monotonic() - start_time)
+            except (OSError, ssl.SSLError) as e:
+                errors.append(f"tls: {e}")
+                break
+    ret = {'reachable': bool(connect_times) and not errors, 'connect_ms': percentiles(connect_times),
+           'errors': errors}
+    if tls:
+        ret['tls_ms'] = percentiles(tls_times)
+    return ret
+
+def file_sizes(paths):
+    """
+    Get the total size of the given files.
+    """
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+def sha256_file(path):
+    """
+    Calculate the sha256 of a file. The file is read in blocks, so memory use doesn't depend on the file size.
+
+    :param path: file
+    :return: sha256 hex digest
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def config_hash(config_parameters):
+    """
+    Calculate the hash of all parameters used to generate the proxy configuration.
+
+    :param config_parameters: list with the parameters of proxy.container_config, without the session
+    :return: sha256 hex digest
+    """
+    import hashlib
+    return hashlib.sha256(json.dumps(config_parameters, sort_keys=True).encode('utf-8')).hexdigest()
+
+def verify_bundle(bundle):
+    """
+    Verify the files of an offline installation bundle against the SHA256SUMS file of the bundle. The
+    manifest must list every file of the bundle, an empty manifest or a file that is not listed is an error.
+
+    :param bundle: directory with the bundle
+    :return: error, and dict with the paths of the RPMs and the image tarballs with their checksums
+    """
+    import re
+    from concurrent.futures import ThreadPoolExecutor
+    manifest = os.path.join(bundle, BUNDLE_MANIFEST)
+    try:
+        with open(manifest, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        return f"Unable to read the bundle manifest {manifest}: {e}", None
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        parts = line.split(None, 1)
+        if len(parts) != 2 or not re.fullmatch(r"[0-9a-fA-F]{64}", parts[0]):
+            return f"Invalid line '{line}' in {manifest}", None
+        checksum, name = parts[0].lower(), parts[1].strip().lstrip("*")
+        if os.path.basename(name) != name:
+            return f"Invalid file name {name} in {manifest}", None
+        entries.append((os.path.join(bundle, name), checksum))
+    if not entries:
+        return f"The bundle manifest {manifest} contains no files", None
+    listed = {os.path.basename(path) for path, _ in entries}
+    try:
+        unlisted = sorted(name for name in os.listdir(bundle) if name != BUNDLE_MANIFEST and name not in listed
+                          and os.path.isfile(os.path.join(bundle, name)))
+    except OSError as e:
+        return f"Unable to read the bundle {bundle}: {e}", None
+    if unlisted:
+        return f"Files {', '.join(unlisted)} of the bundle are not listed in {manifest}", None
+
+    def _check(entry):
+        path, checksum = entry
+        try:
+            return None if sha256_file(path) == checksum else f"Checksum of {path} does not match"
+        except OSError as e:
+            return f"Unable to read {path}: {e}"
+
+    # hashlib releases the GIL for large blocks, so the files are verified in parallel
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        errors = [error for error in executor.map(_check, entries) if error]
+    if errors:
+        return "\n".join(errors), None
+    return None, {'rpms': [path for path, _ in entries if path.endswith(".rpm")],
+                  'images': [(path, checksum) for path, checksum in entries if path.endswith(BUNDLE_IMAGE_EXTENSIONS)]}
+
+def execute_command(cmd, timeout=COMMAND_TIMEOUT, output_limit=COMMAND_OUTPUT_LIMIT):
+    """
+    Execute the given command without a shell. The output is streamed into a buffer that keeps only the first
+    and last part, so large outputs of zypper or mgrpxy don't fill the memory or the return data.
+
+    :param cmd: command as a list of arguments
+    :param timeout: seconds after which the command is killed
+    :param output_limit: maximum number of bytes kept of stdout and of stderr
+    :return: dict with success, message (stdout), error (stderr), retcode, duration and truncated
+    """
+    import signal
+    import subprocess
+    import threading
+    start_time = time.monotonic()
+    stdout = BoundedOutput(output_limit)
+    stderr = BoundedOutput(output_limit)
+    try:
+        # own process group, so children that keep the output open are killed on a timeout as well
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+    except OSError as e:
+        ret = {'success': False, 'message': "", 'error': f"Unable to execute {cmd[0]}: {e}", 'retcode': None,
+               'duration': 0.0, 'truncated': False}
+        log.error(ret['error'])
+        return ret
+    readers = [threading.Thread(target=_read_stream, args=(process.stdout, stdout), daemon=True),
+               threading.Thread(target=_read_stream, args=(process.stderr, stderr), daemon=True)]
+    for reader in readers:
+        reader.start()
+    timed_out = False
+    try:
+        retcode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        os.killpg(process.pid, signal.SIGKILL)
+        retcode = process.wait()
+    for reader in readers:
+        reader.join()
+
+    ret = {'success': retcode == 0 and not timed_out, 'message': stdout.text(), 'retcode': retcode,
+           'duration': round(time.monotonic() - start_time, 3), 'truncated': stdout.truncated or stderr.truncated}
+    if not ret['success']:
+        ret['error'] = stderr.text()
+        if timed_out:
+            ret['error'] = f"{' '.join(cmd)} killed after {timeout} seconds\n{ret['error']}".strip()
+        # only the end of the output is logged, that is where the reason of the failure is
+        log.error(f"{' '.join(cmd)} failed with exit code {retcode}: {ret['error'][-2048:]}")
+    return ret
+
+class ProxyCore:
+    """
+    The functions shared by the smlm_proxy execution module and the smlmproxy state module, bound to the
+    __salt__, __opts__ and __context__ of the calling module.
+    """
+    percentiles = staticmethod(percentiles)
+    probe_port = staticmethod(probe_port)
+    file_sizes = staticmethod(file_sizes)
+    config_hash = staticmethod(config_hash)
+    verify_bundle = staticmethod(verify_bundle)
+    execute_command = staticmethod(execute_command)
+    # timeouts used as default by the modules
+    probe_timeout = PROBE_TIMEOUT
+    read_timeout = SMLM_READ_TIMEOUT
+
+    def __init__(self, salt, opts, context):
+        self.salt = salt
+        self.opts = opts
+        self.context = context
+
+    def phase_timer(self, operation=None):
+        """
+        Get a PhaseTimer. Without operation, no events are sent.
+        """
+        return PhaseTimer(self.salt, operation, self.running_job())
+
+    def running_job(self):
+        """
+        Get the JobProgress of the job executed by this process.
+        :return: JobProgress, or None when not running as job
+        """
+        return self.context.get(JOB_CONTEXT_KEY)
+
+    def job_progress(self, phase, percent=None, bytes_done=0, force=False):
+        """
+        Report the progress of the running job, see JobProgress.update(). Does nothing when not running as job.
+        """
+        progress = self.running_job()
+        if progress is not None:
+            progress.update(phase, percent, bytes_done, force)
+
+    def job_path(self, job_id):
+        """
+        Get the location of the record of a job.
+
+        :param job_id: id of the job
+        :return: path, or None when the id is invalid
+        """
+        if not job_id or not all(c.isalnum() or c == "-" for c in str(job_id)):
+            return None
+        return os.path.join(self.opts['cachedir'], JOBS_DIR, f"{job_id}.json")
+
+    def read_job(self, job_id):
+        """
+        Get the record of a job. Running jobs whose process is gone and queued jobs that didn't start within
+        JOB_START_TIMEOUT seconds get the state lost.
+
+        :param job_id: id of the job
+        :return: dict with the job, or None when the job is unknown
+        """
+        path = self.job_path(job_id)
+        job = read_job(path) if path else None
+        if not job:
+            return job
+        if job.get('state') == "running" and not pid_alive(job.get('pid')):
+            job['state'] = "lost"
+        elif job.get('state') == "queued" and time.time() - job.get('submitted', 0) > JOB_START_TIMEOUT:
+            job['state'] = "lost"
+        return job
+
+    def list_jobs(self, limit=10):
+        """
+        Get the records of the most recent jobs.
+
+        :param limit: maximum number of jobs returned
+        :return: list of jobs, newest first
+        """
+        jobs_dir = os.path.join(self.opts['cachedir'], JOBS_DIR)
+        try:
+            names = sorted((name for name in os.listdir(jobs_dir) if name.endswith(".json")), reverse=True)
+        except OSError:
+            return []
+        jobs = (self.read_job(name[:-len(".json")]) for name in names[:int(limit)])
+        return [job for job in jobs if job]
+
+    def new_job(self, operation, args, kwargs):
+        """
+        Record a new job in the state queued. The oldest records are removed, only JOBS_KEPT are kept.
+
+        :param operation: name of the function executed by the job
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: dict with the job
+        """
+        jobs_dir = os.path.join(self.opts['cachedir'], JOBS_DIR)
+        os.makedirs(jobs_dir, mode=0o700, exist_ok=True)
+        names = sorted(name for name in os.listdir(jobs_dir) if name.endswith(".json"))
+        for name in names[:max(0, len(names) - JOBS_KEPT + 1)]:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(jobs_dir, name))
+        # the id starts with the time of submission, so the ids sort by age
+        job_id = f"{time.strftime('%Y%m%d%H%M%S')}-{os.urandom(4).hex()}"
+        job = {'job': job_id, 'operation': operation, 'args': list(args), 'kwargs': kwargs, 'state': "queued",
+               'submitted': round(time.time(), 3), 'pid': None, 'progress': None, 'result': None}
+        write_job(self.job_path(job_id), job)
+        return job
+
+    def start_job(self, job):
+        """
+        Mark a job as running in this process. The progress of the operation is reported to the job from now on.
+
+        :param job: dict with the job
+        :return: JobProgress
+        """
+        job.update({'state': "running", 'pid': os.getpid(), 'started': round(time.time(), 3)})
+        progress = JobProgress(self.salt, self.job_path(job['job']), job)
+        self.context[JOB_CONTEXT_KEY] = progress
+        progress.update("started", 0, force=True)
+        return progress
+
+    def finish_job(self, ret):
+        """
+        Record the result of the running job and send it as event with tag smlm_proxy/job/<job>/done.
+
+        :param ret: result of the operation
+        :return:
+        """
+        progress = self.context.pop(JOB_CONTEXT_KEY, None)
+        if progress is None:
+            return
+        with progress.lock:
+            job = progress.job
+            job.update({'state': "success" if ret.get('success') else "failed", 'result': ret,
+                        'finished': round(time.time(), 3)})
+            job['duration'] = round(job['finished'] - job['started'], 3)
+            write_job(progress.path, job)
+        try:
+            self.salt['event.send'](f"{JOB_EVENT_TAG}/{job['job']}/done",
+                                    {'job': job['job'], 'operation': job['operation'], 'state': job['state'],
+                                     'duration': job['duration'], 'message': ret.get('message')})
+        except Exception as e:
+            log.debug(f"Unable to send the result of job {job['job']}: {e}")
+
+    def lock_holder(self):
+        """
+        Get the operation holding the operation lock.
+
+        :return: dict with operation, job, pid and started, or None when the lock is free
+        """
+        import fcntl
+        lock_file = os.path.join(self.opts['cachedir'], OPERATION_LOCK_FILE)
+        try:
+            fd = os.open(lock_file, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                with open(fd, 'r', closefd=False) as f:
+                    try:
+                        return json.loads(f.read() or "{}")
+                    except ValueError:
+                        return {}
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return None
+        finally:
+            os.close(fd)
+
+    def lock_error(self, operation):
+        """
+        Check if the operation can be started.
+
+        :param operation: name of the operation to start
+        :return: error naming the running operation, or None when the operation lock is free
+        """
+        holder = self.lock_holder()
+        if holder is None:
+            return None
+        running = holder.get('operation', "another operation")
+        if holder.get('job'):
+            running += f" (job {holder['job']})"
+        return f"Unable to start {operation}, {running} is running on this proxy"
+
+    @contextlib.contextmanager
+    def operation_lock(self, operation):
+        """
+        Allow only one operation changing the proxy at a time, also across processes. The lock is an flock on
+        a file in the minion cachedir, so it is released by the kernel when the process holding it dies.
+        Jobs wait OPERATION_LOCK_WAIT seconds for the lock, other callers fail directly.
+
+        :param operation: name of the operation taking the lock
+        :return: context manager yielding an error, or None when the lock is held
+        """
+        import fcntl
+        lock_file = os.path.join(self.opts['cachedir'], OPERATION_LOCK_FILE)
+        progress = self.running_job()
+        wait_until = time.monotonic() + (OPERATION_LOCK_WAIT if progress is not None else 0)
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= wait_until:
+                        yield self.lock_error(operation) or f"Unable to start {operation}, the proxy is locked"
+                        return
+                    time.sleep(0.5)
+            holder = {'operation': operation, 'job': progress.job['job'] if progress is not None else None,
+                      'pid': os.getpid(), 'started': round(time.time(), 3)}
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps(holder).encode(), 0)
+            try:
+                yield None
+            finally:
+                os.ftruncate(fd, 0)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def software_installed(self):
+        """
+        Check if the proxy software is installed.
+        :return:
+        """
+        return os.path.isfile("/usr/bin/mgrpxy") and os.path.isfile("/usr/bin/podman")
+
+    def software_install(self, internet_access, os_finger, bundle_rpms=None):
+        """
+        Install proxy software.
+
+        :param internet_access:
+        :param os_finger: osfinger grain
+        :param bundle_rpms: RPMs of a verified offline bundle. When given, the container images are not installed
+                            as RPMs, they are loaded from the bundle.
+        :return:
+        """
+        cpu_arch = self.salt['grains.get']('cpuarch')
+
+        if bundle_rpms is not None:
+            packages = ["podman", "uyuni-storage-setup-proxy", "mgrpxy*", "mgrctl*"] + bundle_rpms
+        elif internet_access:
+            packages = ["podman", "uyuni-storage-setup-proxy", "mgrpxy*", "mgrctl*"]
+        else:
+            packages = ["podman", "uyuni-storage-setup-proxy", "mgrpxy*", "mgrctl*",
+                        f"suse-manager-5.0-{cpu_arch}-proxy-*"]
+        if "sle micro" in os_finger.lower():
+            ret = execute_command(["transactional-update", "-i", "pkg", "in"] + packages)
+            if ret['success']:
+                execute_command(["systemctl", "enable", "podman"])
+                ret['message'] = "Software installed. Reboot server and re-issue the same command to install proxy"
+            return ret
+        ret = execute_command(["zypper", "-n", "in"] + packages)
+        if ret['success']:
+            return execute_command(["systemctl", "enable", "--now", "podman"])
+        return ret
+
+    def _mgrpxy_image_defaults(self):
+        """
+        Get the registry and the tag of the proxy images mgrpxy uses by default, from the help of mgrpxy install.
+
+        :return: dict with registry and tag, the keys are missing when not found
+        """
+        import re
+        ret = self.salt['cmd.run_all'](["mgrpxy", "install", "podman", "--help"], python_shell=False,
+                                       ignore_retcode=True)
+        defaults = {}
+        tag = re.search(r'--tag string.*\(default "([^"]+)"\)', ret['stdout'])
+        if tag:
+            defaults['tag'] = tag.group(1)
+        registry = (re.search(r'--registry string.*\(default "([^"]+)"\)', ret['stdout'])
+                    or re.search(r'--httpd-image string.*\(default "([^"]+)/proxy-httpd"\)', ret['stdout']))
+        if registry:
+            # the registry of the module doesn't contain the cpu architecture
+            cpu_arch = self.salt['grains.get']('cpuarch')
+            defaults['registry'] = re.sub(rf"/{re.escape(cpu_arch)}$", "", registry.group(1)) if cpu_arch \
+                else registry.group(1)
+        return defaults
+
+    def image_settings(self, registry=None, tag=None):
+        """
+        Get the registry and the tag of the proxy images, so pull_images and mgrpxy install use the same images.
+
+        :param registry: registry and path of the images, without the cpu architecture. Default is the pillar value
+                         proxy:registry or the default of the installed mgrpxy
+        :param tag: tag of the images. Default is the pillar value proxy:tag or the default of the installed mgrpxy
+        :return: registry, tag and error
+        """
+        pillar = self.salt['pillar.get']('proxy', {}) or {}
+        registry = registry or pillar.get("registry")
+        tag = tag or pillar.get("tag")
+        if not (registry and tag) and self.software_installed():
+            defaults = self._mgrpxy_image_defaults()
+            registry = registry or defaults.get('registry')
+            tag = tag or defaults.get('tag')
+        if not registry or not tag:
+            return None, None, ("The registry and the tag of the proxy images are unknown. Define the pillar values "
+                                "proxy:registry and proxy:tag, or install mgrpxy first.")
+        return str(registry).rstrip("/"), str(tag), None
+
+    def image_references(self, registry, tag, digests=None):
+        """
+        Get the references of the proxy container images. When a digest is given for an image, the image
+        is referenced by its digest, otherwise by its tag.
+
+        :param registry: registry and path of the images, without the cpu architecture
+        :param tag: tag of the images
+        :param digests: dict with the expected digest (sha256:...) per image name, e.g. proxy-httpd
+        :return: dict with per image name the reference
+        """
+        digests = digests or {}
+        cpu_arch = self.salt['grains.get']('cpuarch')
+        references = {}
+        for image in PROXY_IMAGES:
+            repository = f"{registry}/{cpu_arch}/{image}"
+            references[image] = f"{repository}@{digests[image]}" if digests.get(image) else f"{repository}:{tag}"
+        return references
+
+    def image_digest(self, reference):
+        """
+        Get the digest of a local image, without contacting the registry.
+
+        :param reference: image reference
+        :return: digest, or None when the image is not present
+        """
+        ret = self.salt['cmd.run_all'](["podman", "image", "inspect", "--format", "{{.Digest}}", reference],
+                                       python_shell=False, ignore_retcode=True)
+        if ret['retcode'] != 0:
+            return None
+        return ret['stdout'].strip() or None
+
+    def _pillar_number(self, pillar, key, default):
+        """
+        Get a numeric key of the proxy: pillar. The default is only used when the key is missing or empty.
+
+        :param pillar: the proxy: pillar
+        :param key: key below proxy:
+        :param default: value when the key is missing or empty
+        :return: value and error
+        """
+        value = pillar.get(key)
+        if value is None or value == "":
+            return default, None
+        try:
+            return int(value), None
+        except (TypeError, ValueError):
+            return None, f"Pillar keys proxy:{key} is not a number."
+
+    def max_cache(self):
+        """
+        Get the maximum size of the squid cache in MiB from the pillar value proxy:maxcache, validated like
+        check_parameters() does, without requiring the other keys.
+
+        :return: value and error
+        """
+        pillar = self.salt['pillar.get']('proxy', {}) or {}
+        value, err = self._pillar_number(pillar, "maxcache", 2048)
+        if err:
+            err = f"{err} Please fix pillar data for server {self.salt['grains.get']('fqdn')}."
+            log.error(err)
+        return value, err
+
+    def config_deployed(self):
+        """
+        Check if a proxy configuration is deployed in /etc/uyuni/proxy.
+        """
+        return any(os.path.isfile(os.path.join(PROXY_CONFIG_DIR, name)) for name in PROXY_CONFIG_FILES)
+
+    def read_proxy_file(self, name):
+        """
+        Read a deployed configuration file.
+
+        :param name: name of the file in /etc/uyuni/proxy
+        :return: content, or None when the file doesn't exist
+        """
+        try:
+            with open(os.path.join(PROXY_CONFIG_DIR, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_proxy_file(self, name, data):
+        """
+        Replace a file in /etc/uyuni/proxy. The mode of the deployed file is kept.
+
+        :param name: name of the file
+        :param data: new content
+        :return:
+        """
+        path = os.path.join(PROXY_CONFIG_DIR, name)
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+        with open(os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as f:
+            f.write(data)
+        os.chmod(f"{path}.tmp", mode)
+        os.replace(f"{path}.tmp", path)
+
+    def check_parameters(self):
+        """
+        Check if the certificate date is available and if this is the case, load the proxy: pillar
+        into a ProxyConfig. The pillar is read once and all missing or invalid keys are reported together.
+        :return: dict with success and the config, or the error
+        """
+        pillar = self.salt['pillar.get']('proxy', {}) or {}
+        proxy_name = self.salt['grains.get']('fqdn')
+        errors = []
+        for key in ("root_crt", "server_crt", "server_key", "smlmcred", "email"):
+            if not pillar.get(key):
+                errors.append(f"Pillar keys proxy:{key} is empty or not present.")
+        values = {}
+        for key, name, default in (("proxyport", "proxy_port", 8022), ("maxcache", "max_cache", 2048)):
+            values[name], err = self._pillar_number(pillar, key, default)
+            if err:
+                errors.append(err)
+        intermediate_crt = pillar.get("intermediate_crt") or []
+        if isinstance(intermediate_crt, str):
+            intermediate_crt = [intermediate_crt]
+        if errors:
+            err = f"{' '.join(errors)} Please fix pillar data for server {proxy_name}."
+            log.error(err)
+            return {'error': err, 'success': False}
+
+        config = ProxyConfig(root_crt=pillar["root_crt"], server_crt=pillar["server_crt"],
+                             server_key=pillar["server_key"], smlm_cred=pillar["smlmcred"], email=pillar["email"],
+                             proxy_name=proxy_name, smlm=self.salt['grains.get']('master'),
+                             extra_disk=pillar.get("extradisk") or pillar.get("extra_disk") or "",
+                             bundle=pillar.get("bundle") or "",
+                             intermediate_crt=tuple(intermediate_crt), **values)
+        return {'success': True, 'config': config}
+
+    def check_smlm_reachable(self, smlm):
+        """
+        Check if the SMLM API port can be reached. The connection is closed directly.
+
+        :param smlm: hostname of SMLM
+        :return: error, or None when SMLM is reachable
+        """
+        if not probe_port(smlm, SMLM_API_PORT, timeout=SMLM_CONNECT_TIMEOUT)['reachable']:
+            return f"Unable to login to SUSE Manager server {smlm}."
+        return None
+
+    def login_smlm(self, config=None):
+        """
+        Login to SMLM. The session is kept in __context__ and reused until SMLM_SESSION_TTL has passed.
+        Use logout_smlm() to end the session.
+
+        :param config: ProxyConfig with the credentials. When not given, proxy:smlmcred is read from the pillar.
+        :return: error, client connections and session key
+        """
+        smlm = config.smlm if config else self.salt['grains.get']('master')
+        cached = self.context.get(SMLM_SESSION_KEY)
+        if cached and cached['smlm'] == smlm and time.monotonic() < cached['expires']:
+            return None, cached['client'], cached['session']
+        self.logout_smlm()
+
+        error = self.check_smlm_reachable(smlm)
+        if error:
+            return error, None, None
+        client = smlm_client(smlm)
+        if config:
+            smlm_cred = config.smlm_cred
+        else:
+            smlm_cred = (self.salt['pillar.get']('proxy', {}) or {}).get("smlmcred")
+            if not smlm_cred:
+                error = (f"Pillar keys proxy:smlmcred is empty or not present. Please fix pillar data for "
+                         f"server {self.salt['grains.get']('fqdn')}.")
+                client('close')()
+                return error, None, None
+        try:
+            session = smlm_login(client, smlm_cred)
+        except Exception:
+            client('close')()
+            error = f"Unable to login to SUSE Manager server {smlm}."
+            return error, None, None
+        self.context[SMLM_SESSION_KEY] = {'smlm': smlm, 'client': client, 'session': session,
+                                          'expires': time.monotonic() + SMLM_SESSION_TTL}
+        return None, client, session
+
+    def logout_smlm(self):
+        """
+        Logout from SMLM when a session is present and close the connection.
+        :return:
+        """
+        cached = self.context.pop(SMLM_SESSION_KEY, None)
+        if not cached:
+            return
+        try:
+            cached['client'].auth.logout(cached['session'])
+        except Exception as e:
+            log.debug(f"Logout from SUSE Manager server {cached['smlm']} failed: {e}")
+        finally:
+            cached['client']('close')()
+
+    def cached_config(self, config_hash):
+        """
+        Get the path of a cached configuration file generated with the same parameters.
+
+        :param config_hash: hash of the parameters
+        :return: path of the cached file, or None when no valid file is present
+        """
+        import tarfile
+        cached_file = os.path.join(self.opts['cachedir'], CONFIG_CACHE_DIR, f"{config_hash}.tar.gz")
+        if os.path.isfile(cached_file) and tarfile.is_tarfile(cached_file):
+            return cached_file
+        return None
+
+    def store_config(self, config_hash, data):
+        """
+        Store the configuration file in the cache. Files of other parameter sets are removed, as they are outdated
+        and contain the private key of the proxy.
+
+        :param config_hash: hash of the parameters
+        :param data: content of the configuration file
+        :return:
+        """
+        cache_dir = os.path.join(self.opts['cachedir'], CONFIG_CACHE_DIR)
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            for name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, name))
+            cached_file = os.path.join(cache_dir, f"{config_hash}.tar.gz")
+            with open(os.open(cached_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            log.warning(f"Unable to cache the proxy configuration: {e}")
+
+    def staged_config(self, config_hash):
+        """
+        Get a configuration staged in the pillar of this proxy by the smlm_proxy runner.
+
+        :param config_hash: hash of the parameters
+        :return: content of the configuration file, or None when no configuration is staged
+        """
+        import base64
+        import binascii
+        import io
+        import tarfile
+        staged = self.salt['pillar.get'](f"{STAGED_CONFIG_PILLAR}:{config_hash}", None)
+        if not staged:
+            return None
+        try:
+            data = base64.b64decode(staged, validate=True)
+        except (binascii.Error, TypeError, ValueError) as e:
+            log.warning(f"Invalid proxy configuration staged in pillar {STAGED_CONFIG_PILLAR}: {e}")
+            return None
+        if not tarfile.is_tarfile(io.BytesIO(data)):
+            log.warning(f"Invalid proxy configuration staged in pillar {STAGED_CONFIG_PILLAR}: not a tar file")
+            return None
+        return data
+
+    def desired_config(self, config, timer=None):
+        """
+        Get the configuration file of the proxy from SMLM. When a configuration generated with the same
+        parameters is cached, or staged in the pillar of the proxy by the smlm_proxy runner, it is used without
+        contacting SMLM.
+
+        :param config: ProxyConfig of this proxy
+        :param timer: PhaseTimer recording the login and the fetch of the configuration
+        :return: error and the content of the configuration file
+        """
+        timer = timer or self.phase_timer()
+        config_parameters = config.container_config_parameters()
+        parameters_hash = config_hash(config_parameters)
+        cached_file = self.cached_config(parameters_hash)
+        if cached_file:
+            log.debug(f"Using cached proxy configuration {cached_file}")
+            with timer.phase("config_fetch") as phase:
+                with open(cached_file, 'rb') as f:
+                    config_data = f.read()
+                phase['outcome'] = "cached"
+                phase['bytes'] = len(config_data)
+            return None, config_data
+
+        # configuration generated on the master by the smlm_proxy runner
+        with timer.phase("config_staged") as phase:
+            config_data = self.staged_config(parameters_hash)
+            phase['outcome'] = "missing" if config_data is None else "success"
+            phase['bytes'] = len(config_data or b"")
+        if config_data is not None:
+            log.debug("Using proxy configuration staged by the smlm_proxy runner")
+            self.store_config(parameters_hash, config_data)
+            return None, config_data
+
+        # login to SMLM
+        with timer.phase("login") as phase:
+            err, client, session = self.login_smlm(config)
+            if err:
+                phase['outcome'] = "failed"
+                return err, None
+
+        # ask smlm to create the config file
+        with timer.phase("config_fetch") as phase:
+            try:
+                config_file = client.proxy.container_config(session, *config_parameters)
+            except Exception:
+                phase['outcome'] = "failed"
+                return "Unable to get config file", None
+            config_data = config_file.data
+            phase['bytes'] = len(config_data)
+        self.store_config(parameters_hash, config_data)
+        return None, config_data
+
+    def get_config(self, config, timer=None):
+        """
+        Get the configuration file of the proxy and write it to /etc/uyuni/config.tar.gz.
+
+        :param config: ProxyConfig of this proxy
+        :param timer: PhaseTimer recording the login and the fetch of the configuration
+        :return:
+        """
+        err, config_data = self.desired_config(config, timer)
+        if err:
+            return {'error': err, 'success': False}
+        try:
+            # Ensure the directory exists before writing the file
+            os.makedirs(os.path.dirname(PROXY_CONFIG_FILE), exist_ok=True)
+            with open(PROXY_CONFIG_FILE, 'wb') as f:
+                f.write(config_data)
+        except Exception as file_write_error:
+            return {'error': f"Error when writing the file\n{str(file_write_error)}\n{PROXY_CONFIG_FILE}",
+                    'success': False}
+        return {'success': True}
+
+    def load_bundle_images(self, images):
+        """
+        Load the container images of the bundle with podman. Tarballs loaded before are skipped.
+
+        :param images: list with the path and the checksum of the image tarballs
+        :return:
+        """
+        loaded_file = os.path.join(self.opts['cachedir'], BUNDLE_LOADED_FILE)
+        try:
+            with open(loaded_file, 'r') as f:
+                loaded = json.load(f)
+        except (OSError, ValueError):
+            loaded = []
+        for path, checksum in images:
+            if checksum in loaded:
+                log.debug(f"Image tarball {path} already loaded")
+                continue
+            ret = execute_command(["podman", "load", "--input", path])
+            if not ret['success']:
+                return ret
+            loaded.append(checksum)
+            try:
+                os.makedirs(os.path.dirname(loaded_file), exist_ok=True)
+                with open(loaded_file, 'w') as f:
+                    json.dump(loaded, f)
+            except OSError as e:
+                log.warning(f"Unable to write {loaded_file}: {e}")
+        return {'success': True, 'message': f"{len(images)} image tarballs loaded"}
+
+    def mgrpxy_install(self, bundle, timer=None):
+        """
+        Install the proxy containers with mgrpxy, using the configuration in /etc/uyuni/config.tar.gz.
+
+        :param bundle: verified offline installation bundle, or None
+        :param timer: PhaseTimer recording the loading of the images and mgrpxy install
+        :return:
+        """
+        timer = timer or self.phase_timer()
+        install_cmd = ["mgrpxy", "install", "podman"]
+        registry, tag, err = self.image_settings()
+        references = {} if err else self.image_references(registry, tag)
+        # mgrpxy keeps its own images, unless the pillar selects the registry or the tag, like for pull_images
+        pillar = self.salt['pillar.get']('proxy', {}) or {}
+        if pillar.get("tag"):
+            install_cmd += ["--tag", str(pillar["tag"])]
+        if references and pillar.get("registry"):
+            for image, option in PROXY_IMAGES.items():
+                install_cmd += [f"--{option}-image", references[image].rsplit(":", 1)[0]]
+        # load the container images of the bundle, so they don't have to be pulled
+        if bundle:
+            with timer.phase("images_load") as phase:
+                result = self.load_bundle_images(bundle['images'])
+                phase['outcome'] = "success" if result["success"] else "failed"
+                phase['bytes'] = file_sizes([path for path, _ in bundle['images']])
+            if not result["success"]:
+                return result
+            install_cmd += ["--pullPolicy", "IfNotPresent"]
+        elif references and self.salt['cmd.run_all'](["podman", "image", "inspect", "--format", "{{.Id}}"]
+                                                     + list(references.values()), python_shell=False,
+                                                     ignore_retcode=True)['retcode'] == 0:
+            # all images are present, the downtime of the installation doesn't include pulling them
+            install_cmd += ["--pullPolicy", "IfNotPresent"]
+
+        # start the proxy
+        with timer.phase("mgrpxy_install") as phase:
+            result = execute_command(install_cmd + [PROXY_CONFIG_FILE])
+            phase['outcome'] = "success" if result["success"] else "failed"
+        return result
+
+    def preflight(self, check_if_active, software_installed, running_is_error=True):
+        """
+        Run the independent checks needed before installing the proxy at the same time. All checks are
+        executed, so every problem is reported at once.
+
+        :param check_if_active: function of the module checking if the proxy is running or configured
+        :param software_installed: function of the module checking if the proxy software is installed
+        :param running_is_error: When False, a proxy that is already running or configured is not an error,
+                                 it is returned as deployed
+        :return: dict with success, the errors, the time per check and the results of the checks
+        """
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+        checks = {'active': check_if_active,
+                  'parameters': self.check_parameters,
+                  'software': software_installed,
+                  'smlm_reachable': lambda: self.check_smlm_reachable(self.salt['grains.get']('master')),
+                  'osfinger': lambda: self.salt['grains.get']('osfinger')}
+
+        def _timed(check):
+            start_time = time.monotonic()
+            try:
+                return check(), None, time.monotonic() - start_time
+            except Exception as e:
+                return None, e, time.monotonic() - start_time
+
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            # every thread gets a copy of the context, so __salt__ and friends are available in the checks
+            futures = {name: executor.submit(contextvars.copy_context().run, _timed, check)
+                       for name, check in checks.items()}
+        results = {}
+        timings = {}
+        errors = []
+        for name, future in futures.items():
+            result, exception, duration = future.result()
+            timings[name] = round(duration, 3)
+            if exception is not None:
+                errors.append(f"Check {name} failed: {exception}")
+            results[name] = result
+
+        deployed = bool(results['active'] and results['active']['success'])
+        if deployed and running_is_error:
+            errors.append("Proxy already running")
+        if results['parameters'] and not results['parameters']['success']:
+            errors.append(results['parameters']['error'])
+        if results['smlm_reachable']:
+            errors.append(results['smlm_reachable'])
+        if errors:
+            log.error(f"Preflight checks failed: {' '.join(errors)}")
+        return {'success': not errors, 'errors': errors, 'timings': timings,
+                'config': results['parameters']['config'] if not errors else None,
+                'software_installed': bool(results['software']), 'os_finger': results['osfinger'] or "",
+                'deployed': deployed}
+
+    def containers_status(self, images=True):
+        """
+        Collect the status of the uyuni-proxy-* units directly from systemd and podman.
+        This avoids 'mgrpxy status', which returns the complete unit, process and journal output.
+
+        :param images: When False, podman is not asked for the images of the containers
+        :return: dict with per container the active state, since timestamp, image and restart count
+        """
+        unit_files = self.salt['cmd.run_all'](["systemctl", "list-unit-files", "--type=service", "--no-legend",
+                                               PROXY_UNIT_PATTERN], python_shell=False, ignore_retcode=True)
+        units = [line.split()[0] for line in unit_files['stdout'].splitlines()
+                 if line.strip() and not line.split()[0].endswith("@.service")]
+        if not units:
+            return {}
+
+        container_images = {}
+        if images:
+            podman_ps = self.salt['cmd.run_all'](["podman", "ps", "--all", "--format", "json", "--filter",
+                                                  "name=uyuni-proxy-"], python_shell=False, ignore_retcode=True)
+            if podman_ps['retcode'] == 0 and podman_ps['stdout'].strip():
+                try:
+                    for container in json.loads(podman_ps['stdout']):
+                        for container_name in container.get('Names', []):
+                            container_images[container_name] = container.get('Image')
+                except ValueError:
+                    log.warning("Unable to parse the output of podman ps")
+
+        unit_show = self.salt['cmd.run_all'](["systemctl", "show", f"--property={PROXY_UNIT_PROPERTIES}"] + units,
+                                             python_shell=False, ignore_retcode=True)
+        containers = {}
+        for block in unit_show['stdout'].split("\n\n"):
+            properties = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+            if not properties.get('Id'):
+                continue
+            name = properties['Id'].rsplit(".service", 1)[0]
+            try:
+                restarts = int(properties.get('NRestarts') or 0)
+            except ValueError:
+                restarts = 0
+            containers[name] = {'active': properties.get('ActiveState'),
+                                'sub': properties.get('SubState'),
+                                'since': properties.get('ActiveEnterTimestamp') or None,
+                                'image': container_images.get(name),
+                                'restarts': restarts}
+        return containers